@@ -6,8 +6,13 @@ import configparser
 import pathlib
 import shutil
 import subprocess
+import sys
 from typing import Dict, List
 
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent / "tools"))
+import instrument
+import serve_site
+
 
 def read_secrets_file(fpath: pathlib.Path) -> dict:
     """
@@ -95,6 +100,7 @@ def decode_secrets_file(src_fpath: pathlib.Path, dst_fpath: pathlib.Path):
     write_secrets_file(secrets, dst_fpath)
 
 
+@instrument.timed
 def insert_isso_config_secrets(
     src_fpath: pathlib.Path, dst_fpath: pathlib.Path, secrets: Dict[str, str]
 ):
@@ -121,33 +127,62 @@ def insert_isso_config_secrets(
         config.write(f)
 
 
-def build_site(secrets_fpath: pathlib.Path, hugo_args: str = None):
+def hugo_build_dir(hugo_args: str = None) -> pathlib.Path:
     """
-    TODO
+    Return the directory hugo builds the site into when passed the additional
+    arguments `hugo_args` (see :func:`build_site`): the destination given with
+    `-d`/`--destination`, or `public`.
     """
-    build_dir = pathlib.Path("./public")
-    hugo_cmd = ["hugo"]
+    hugo_args = hugo_args.strip().split() if hugo_args else []
+    for idx, arg in enumerate(hugo_args):
+        if arg in ("-d", "--destination") and idx + 1 < len(hugo_args):
+            return pathlib.Path(hugo_args[idx + 1])
+        if arg.startswith("--destination="):
+            return pathlib.Path(arg[len("--destination="):])
+    return pathlib.Path("./public")
+
+
+@instrument.timed
+def build_site(
+    secrets_fpath: pathlib.Path, hugo_args: str = None
+) -> pathlib.Path:
+    """
+    Build the site with hugo and update contact.php with the path to the
+    secrets file.
 
-    if hugo_args:
-        hugo_args = hugo_args.strip().split()
+    Returns:
+        Path to the build directory.
 
-        # Check if a different build directory has been specified.
-        try:
-            option_idx = hugo_args.index("-d")
-            build_dir = pathlib.Path(hugo_args[option_idx + 1])
-        except ValueError:
-            pass
+    Raises:
+        FileNotFoundError: If the self-hosted third-party assets have not
+            been fetched into `static/vendor/` (see `tools/vendor_assets.py`).
+    """
+    # Imported here for the same reason as in :func:`post_build`.
+    import vendor_assets
+
+    missing = vendor_assets.missing_assets()
+    if missing:
+        raise FileNotFoundError(
+            "Vendored assets missing from static/ (run "
+            "`python tools/vendor_assets.py fetch`):\n"
+            + "\n".join(str(fpath) for fpath in missing)
+        )
+
+    build_dir = hugo_build_dir(hugo_args)
+    hugo_cmd = ["hugo"]
 
-        hugo_cmd.extend(hugo_args)
+    if hugo_args:
+        hugo_cmd.extend(hugo_args.strip().split())
 
     if build_dir.exists():
         # Delete if a previous build exists to ensure nothing from a previous
         # build is inadvertently deployed/preserved.
         shutil.rmtree(build_dir)
 
-    proc = subprocess.run(
-        hugo_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
+    with instrument.span("hugo"):
+        proc = subprocess.run(
+            hugo_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
 
     if proc.returncode != 0:
         raise RuntimeError(proc.stderr.decode())
@@ -169,7 +204,80 @@ def build_site(secrets_fpath: pathlib.Path, hugo_args: str = None):
     with open(contact_php_fpath, "w") as f:
         f.writelines(lines)
 
+    return build_dir
+
+
+def post_build(
+    build_dir: pathlib.Path,
+    subset_fonts: bool = True,
+    lazy: bool = True,
+    image_index_fpath: pathlib.Path = None,
+    fingerprint: bool = True,
+    cache_conf_fpath: pathlib.Path = None,
+    weight_report_fpath: pathlib.Path = None,
+    budgets: Dict[str, int] = None,
+):
+    """
+    Run the post-build stages on the output of :func:`build_site`.
+
+    Args:
+        build_dir: Path to the build directory.
+        subset_fonts: Subset the self-hosted web font to the characters
+            rendered in it (see `tools/vendor_assets.py`).
+        lazy: Add intrinsic dimensions, lazy loading, and async decoding to
+            images (see `tools/lazy_images.py`).
+        image_index_fpath: Path to the image dimension index cache.
+        fingerprint: Rename static assets to content-hashed filenames and
+            rewrite references to them (see `tools/fingerprint_assets.py`).
+        cache_conf_fpath: Path to which the Apache cache header config for
+            fingerprinted assets is written.
+        weight_report_fpath: Path to which the per-page weight report is
+            written (see `tools/page_weight.py`).
+        budgets: Dict of page weight budgets with keys "max_bytes",
+            "max_requests", and "max_third_party"; omitted or `None` budgets
+            are not enforced.
+
+    Raises:
+        RuntimeError: If any page exceeds a page weight budget.
+    """
+    # The post-build stages need third-party packages (see README) that the
+    # other actions do not, so they are only imported when used.
+    import fingerprint_assets
+    import lazy_images
+    import page_weight
+    import vendor_assets
+
+    # The stages share one pool of worker processes, each of which parses
+    # the pages in `build_dir` (see `tools/site_pages.py`).
+    with instrument.ProcessPool() as pool:
+        # Must run before fingerprinting so the hash is that of the subset.
+        if subset_fonts:
+            vendor_assets.subset_web_font(build_dir, pool=pool)
+
+        # Must run before fingerprinting, which renames the images.
+        if lazy:
+            lazy_images.lazy_images(
+                build_dir, index_fpath=image_index_fpath, pool=pool
+            )
+
+        if fingerprint:
+            fingerprint_assets.fingerprint_assets(
+                build_dir, conf_fpath=cache_conf_fpath, pool=pool
+            )
+
+        # Weigh pages last so the report reflects what will be deployed.
+        violations = page_weight.weight_report(
+            build_dir, report_fpath=weight_report_fpath, pool=pool,
+            **(budgets or {})
+        )
+
+    if violations:
+        raise RuntimeError(
+            "Page weight budget exceeded:\n" + "\n".join(violations)
+        )
+
 
+@instrument.timed
 def deploy_site(deploy_dir: pathlib.Path, delete_existing: bool = False):
     """
     Copy the built site files (`./public/*`) to the deploy dir (e.g.,
@@ -180,7 +288,7 @@ def deploy_site(deploy_dir: pathlib.Path, delete_existing: bool = False):
         delete_existing: If `deploy_dir` exists, delete the entire directory
             tree before copying files.
     """
-    if deploy_dir_exists and delete_existing:
+    if deploy_dir.exists() and delete_existing:
         shutil.rmtree(deploy_dir)
 
     build_dir = pathlib.Path("public")
@@ -190,9 +298,10 @@ def deploy_site(deploy_dir: pathlib.Path, delete_existing: bool = False):
 def get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "action", type=str, choices=["build", "deploy", "encode", "decode"],
-        help="build (without deploying), deploy (without building), or "
-            "encode/decode a secrets file"
+        "action", type=str,
+        choices=["build", "deploy", "encode", "decode", "serve"],
+        help="build (without deploying), deploy (without building), "
+            "encode/decode a secrets file, or serve the built site locally"
     )
     parser.add_argument(
         "-s", "--secrets", type=pathlib.Path,
@@ -218,8 +327,56 @@ def get_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument(
         "-H", "--hugo-args", type=str, default=None,
-        help="String of additional argument(s) to pass to hugo for build"
+        help="String of additional argument(s) to pass to hugo for build; "
+            "with serve, only used to find the build directory (-d)"
+    )
+    parser.add_argument(
+        "--no-subset-fonts", action="store_true",
+        help="Do not subset the self-hosted web font after building"
+    )
+    parser.add_argument(
+        "--no-lazy-images", action="store_true",
+        help="Do not add dimensions and lazy loading to images after building"
+    )
+    parser.add_argument(
+        "--image-index", type=pathlib.Path, default=".image-index.json",
+        help="Path to image dimension index cache"
+    )
+    parser.add_argument(
+        "--no-fingerprint", action="store_true",
+        help="Do not fingerprint static assets after building"
+    )
+    parser.add_argument(
+        "--cache-conf", type=pathlib.Path, default="cache-headers.conf",
+        help="Path to output Apache config fragment with cache headers for "
+            "fingerprinted assets"
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=1313,
+        help="Port for serve option"
+    )
+    parser.add_argument(
+        "--cache-mb", type=float, default=64,
+        help="Size of the serve option's in-memory file cache (MiB)"
+    )
+    parser.add_argument(
+        "--budget-bytes", type=int, default=None,
+        help="Fail if any page (with its resources) exceeds this many bytes"
+    )
+    parser.add_argument(
+        "--budget-requests", type=int, default=None,
+        help="Fail if any page makes more than this many requests"
+    )
+    parser.add_argument(
+        "--budget-third-party", type=int, default=None,
+        help="Fail if any page makes more than this many third-party "
+            "requests"
+    )
+    parser.add_argument(
+        "--weight-report", type=pathlib.Path, default="page-weight.json",
+        help="Path to output JSON page weight report"
     )
+    instrument.add_arguments(parser)
     return parser
 
 
@@ -245,21 +402,43 @@ if __name__ == "__main__":
 
     validate_args(args)
 
-    if args.action == "encode":
-        encode_secrets_file(args.secrets, args.output)
-    elif args.action == "decode":
-        decode_secrets_file(args.secrets, args.output)
-    else:
-        build = args.action == "build"
-        deploy = (args.action == "deploy") or (build and args.deploy)
-
-        if build:
-            secrets = read_secrets_file(args.secrets)
-            decode_secrets(secrets)
-            insert_isso_config_secrets(
-                args.isso_src, args.isso_dst, secrets
+    with instrument.profile_run(args):
+        if args.action == "encode":
+            encode_secrets_file(args.secrets, args.output)
+        elif args.action == "decode":
+            decode_secrets_file(args.secrets, args.output)
+        elif args.action == "serve":
+            serve_site.serve(
+                hugo_build_dir(args.hugo_args), port=args.port,
+                cache_bytes=int(args.cache_mb * 2**20)
             )
-            build_site(args.secrets, hugo_args=args.hugo_args)
-        if deploy:
-            raise RuntimeWarning("Will not work unless you are superuser")
-            deploy_site(args.output, delete_existing=True)
+        else:
+            build = args.action == "build"
+            deploy = (args.action == "deploy") or (build and args.deploy)
+
+            if build:
+                secrets = read_secrets_file(args.secrets)
+                decode_secrets(secrets)
+                insert_isso_config_secrets(
+                    args.isso_src, args.isso_dst, secrets
+                )
+                build_dir = build_site(
+                    args.secrets, hugo_args=args.hugo_args
+                )
+                post_build(
+                    build_dir,
+                    subset_fonts=not args.no_subset_fonts,
+                    lazy=not args.no_lazy_images,
+                    image_index_fpath=args.image_index,
+                    fingerprint=not args.no_fingerprint,
+                    cache_conf_fpath=args.cache_conf,
+                    weight_report_fpath=args.weight_report,
+                    budgets={
+                        "max_bytes": args.budget_bytes,
+                        "max_requests": args.budget_requests,
+                        "max_third_party": args.budget_third_party,
+                    },
+                )
+            if deploy:
+                raise RuntimeWarning("Will not work unless you are superuser")
+                deploy_site(args.output, delete_existing=True)
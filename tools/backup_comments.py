@@ -0,0 +1,340 @@
+"""
+Back up and restore the Isso comments database without blocking the live
+server.
+
+Full backups and restores use SQLite's online backup API, copying a limited
+number of pages per step and sleeping between steps so that Isso can keep
+reading and writing the database while the copy is in progress.
+
+Incremental exports write the comments that changed since the previous export
+to a JSON Lines file (one comment per line, including its thread's URI and
+title), so a nightly export file is only the size of the difference. Isso does
+not bump `modified` for every change (e.g., approving a comment in moderation
+only sets `mode`, and deleting a comment with replies blanks its text and
+author), so changes are found by content rather than by timestamp: a JSON
+state file records a digest of every exported comment, and each export reads
+the comments and writes those whose digest differs. Comments deleted outright
+are written as deletion records (`{"id": ..., "deleted": true}`). Incremental
+exports can be applied on top of a restored full backup with the `import`
+action.
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+from typing import Iterable
+
+import instrument
+
+
+def _progress(status, remaining, total):
+    done = total - remaining
+    print(f"\rCopied {done}/{total} pages", end="" if remaining else "\n")
+
+
+@instrument.timed
+def backup(
+    db_path: pathlib.Path,
+    dst_path: pathlib.Path,
+    pages: int = 64,
+    sleep: float = 0.05,
+    verbose: bool = True,
+):
+    """
+    Copy the live database at `db_path` to `dst_path` with SQLite's online
+    backup API.
+
+    Args:
+        db_path: Path to the Isso database (e.g., `comments.db`).
+        dst_path: Path to the backup file (overwritten if it exists).
+        pages: Number of pages copied per step; the source database is only
+            locked while a step is in progress.
+        sleep: Seconds to sleep between steps so the server can write.
+        verbose: Print progress.
+    """
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        with dst:
+            src.backup(
+                dst, pages=pages, sleep=sleep,
+                progress=_progress if verbose else None
+            )
+    finally:
+        dst.close()
+        src.close()
+
+
+@instrument.timed
+def restore(
+    backup_path: pathlib.Path,
+    db_path: pathlib.Path,
+    pages: int = 64,
+    sleep: float = 0.05,
+    verbose: bool = True,
+):
+    """
+    Restore the database at `db_path` from a backup made by :func:`backup`.
+    The copy is made in steps of `pages` pages (see :func:`backup`); Isso
+    should be stopped or in read-only use while restoring, since the restored
+    contents replace its database wholesale.
+    """
+    src = sqlite3.connect(backup_path)
+    dst = sqlite3.connect(db_path)
+    try:
+        with dst:
+            src.backup(
+                dst, pages=pages, sleep=sleep,
+                progress=_progress if verbose else None
+            )
+    finally:
+        dst.close()
+        src.close()
+
+
+def _encode(value):
+    # JSON has no bytes type; blobs (e.g., the `voters` bloom filter) are
+    # stored as base64.
+    if isinstance(value, bytes):
+        return {"$base64": base64.b64encode(value).decode("utf-8")}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "$base64" in value:
+        return base64.b64decode(value["$base64"])
+    return value
+
+
+def read_state(state_path: pathlib.Path) -> dict:
+    state = {"digests": {}, "exports": []}
+    if state_path.exists():
+        with open(state_path, "r") as f:
+            state.update(json.load(f))
+    return state
+
+
+def _reserve_export_path(out_dir: pathlib.Path) -> pathlib.Path:
+    """
+    Create and return a new, empty export file in `out_dir`. Names sort in
+    the order the exports were made; a counter is appended if an export with
+    the same timestamp already exists.
+    """
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    for counter in itertools.count():
+        # "_" sorts after ".", so a suffixed name sorts after the original.
+        suffix = f"_{counter}" if counter else ""
+        out_path = out_dir / f"comments-{stamp}{suffix}.jsonl"
+        try:
+            open(out_path, "x").close()
+            return out_path
+        except FileExistsError:
+            continue
+
+
+def comment_digest(comment: dict) -> str:
+    """
+    Digest of an (encoded) exported comment, including its thread's URI and
+    title, used to detect changes between exports.
+    """
+    data = json.dumps(comment, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+@instrument.timed
+def export_incremental(
+    db_path: pathlib.Path,
+    out_dir: pathlib.Path,
+    state_path: pathlib.Path = None,
+    batch_size: int = 500,
+) -> pathlib.Path:
+    """
+    Export the comments added, changed, or deleted since the last export to a
+    JSON Lines file in `out_dir`.
+
+    Args:
+        db_path: Path to the Isso database.
+        out_dir: Directory for the exported `comments-<time>.jsonl` files.
+            Each export gets a new file; existing files are never modified.
+        state_path: Path to the export state file (default:
+            `<out_dir>/state.json`).
+        batch_size: Number of rows fetched from the database at a time.
+    Returns:
+        Path to the exported file, or `None` if nothing changed.
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if state_path is None:
+        state_path = out_dir / "state.json"
+
+    state = read_state(state_path)
+    old_digests = state["digests"]
+    digests = {}
+
+    # Open read-only so the export never takes a write lock on the live DB.
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.execute(
+        "select comments.*, threads.uri as thread_uri,"
+        " threads.title as thread_title"
+        " from comments join threads on threads.id = comments.tid"
+        " order by comments.id"
+    )
+    columns = [description[0] for description in cursor.description]
+
+    num_rows = 0
+
+    # Write to a temporary file, which only becomes an export if it is not
+    # empty.
+    with tempfile.NamedTemporaryFile(
+        "w", dir=out_dir, prefix=".comments-", suffix=".tmp", delete=False
+    ) as f:
+        tmp_path = pathlib.Path(f.name)
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    comment = {
+                        column: _encode(value)
+                        for column, value in zip(columns, row)
+                    }
+                    # JSON object keys are strings, so ids are kept as
+                    # strings.
+                    comment_id = str(comment["id"])
+                    digests[comment_id] = comment_digest(comment)
+                    if digests[comment_id] != old_digests.get(comment_id):
+                        f.write(json.dumps(comment) + "\n")
+                        num_rows += 1
+
+            deleted_ids = old_digests.keys() - digests.keys()
+            for comment_id in sorted(deleted_ids, key=int):
+                deleted = {"id": int(comment_id), "deleted": True}
+                f.write(json.dumps(deleted) + "\n")
+                num_rows += 1
+        except BaseException:
+            f.close()
+            tmp_path.unlink()
+            raise
+    conn.close()
+
+    if num_rows == 0:
+        tmp_path.unlink()
+        return None
+
+    out_path = _reserve_export_path(out_dir)
+    os.replace(tmp_path, out_path)
+
+    state.pop("since", None)
+    state["digests"] = digests
+    state["exports"].append(out_path.name)
+
+    # Replace the state file atomically so an interrupted write cannot lose
+    # the digests of the comments already exported.
+    tmp_state_path = state_path.with_name(state_path.name + ".tmp")
+    with open(tmp_state_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_state_path, state_path)
+
+    return out_path
+
+
+@instrument.timed
+def import_incremental(db_path: pathlib.Path, jsonl_paths: Iterable):
+    """
+    Apply incremental exports (oldest first) to the database at `db_path`,
+    e.g., on top of a restored full backup. Comments are inserted or replaced
+    by id, missing threads are created with their original ids, and deleted
+    comments are deleted.
+    """
+    conn = sqlite3.connect(db_path)
+    comment_columns = {
+        row[1] for row in conn.execute("pragma table_info(comments)")
+    }
+
+    with conn:
+        for jsonl_path in jsonl_paths:
+            with open(jsonl_path, "r") as f:
+                for line in f:
+                    comment = {
+                        column: _decode(value)
+                        for column, value in json.loads(line).items()
+                    }
+                    if comment.get("deleted"):
+                        conn.execute(
+                            "delete from comments where id = ?",
+                            (comment["id"],),
+                        )
+                        continue
+
+                    conn.execute(
+                        "insert or ignore into threads (id, uri, title)"
+                        " values (?, ?, ?)",
+                        (
+                            comment["tid"], comment["thread_uri"],
+                            comment["thread_title"]
+                        ),
+                    )
+
+                    columns = [c for c in comment if c in comment_columns]
+                    conn.execute(
+                        f"insert or replace into comments"
+                        f" ({', '.join(columns)})"
+                        f" values ({', '.join('?' * len(columns))})",
+                        [comment[c] for c in columns],
+                    )
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "action", type=str, choices=["backup", "restore", "export", "import"],
+        help="backup (online copy of the DB), restore (from a backup), "
+            "export (incremental JSON Lines export of changed comments), or "
+            "import (apply incremental exports)"
+    )
+    parser.add_argument(
+        "paths", type=pathlib.Path, nargs="*",
+        help="backup: backup file; restore: backup file; export: output "
+            "directory; import: JSON Lines file(s), oldest first"
+    )
+    parser.add_argument(
+        "--db", type=pathlib.Path, default="comments.db",
+        help="Path to Isso comments database"
+    )
+    parser.add_argument(
+        "--pages", type=int, default=64,
+        help="Pages copied per backup/restore step"
+    )
+    parser.add_argument(
+        "--sleep", type=float, default=0.05,
+        help="Seconds to sleep between backup/restore steps"
+    )
+    parser.add_argument(
+        "--state", type=pathlib.Path, default=None,
+        help="Path to incremental export state file (default: "
+            "<output directory>/state.json)"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    assert args.paths, "Path(s) missing"
+
+    with instrument.profile_run(args):
+        if args.action == "backup":
+            backup(args.db, args.paths[0], pages=args.pages, sleep=args.sleep)
+        elif args.action == "restore":
+            restore(
+                args.paths[0], args.db, pages=args.pages, sleep=args.sleep
+            )
+        elif args.action == "export":
+            out_path = export_incremental(
+                args.db, args.paths[0], state_path=args.state
+            )
+            print(out_path or "No changed comments")
+        elif args.action == "import":
+            import_incremental(args.db, args.paths)
@@ -0,0 +1,393 @@
+"""
+Benchmark how the site build pipeline scales with the number of posts.
+
+For each requested size, a synthetic copy of the site is generated in a
+temporary directory: the config, layouts, assets, static files, and theme are
+copied from the repo and `content/blog` is replaced with synthetic posts
+modeled on the real ones (front matter, `highlight`/`figure`/`ref`/`youtube`
+shortcodes, KaTeX, and reference-style links). Each stage of the pipeline is
+then run in its own subprocess against that site and its wall time, peak RSS
+(including any child processes such as hugo), and output size are recorded.
+
+Stages:
+    isso: write the Isso config with secrets (`insert_isso_config_secrets`)
+    build: `build_site` (hugo plus the contact.php update) and the post-build
+        stages
+    format: `format_posts.format_file` on every synthetic post
+    deploy: `deploy_site` to a scratch directory
+
+With the profiling options (see `instrument.py`), each stage subprocess is
+also profiled and writes its own report, e.g.,
+`bench_build.100.build.profile.json`, alongside the benchmark's.
+"""
+import argparse
+import json
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import instrument
+
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+SITE_ITEMS = [
+    "archetypes", "assets", "config.toml", "content", "layouts", "static",
+    "themes", "isso.cfg.nosecrets", "secrets.txt.example",
+]
+STAGES = ["isso", "build", "format", "deploy"]
+
+CATEGORIES = [
+    "Algorithms", "Computer Vision", "Deep Learning", "Machine Learning",
+    "Mechanical Engineering", "Programming", "Robotics", "Web Development",
+]
+TAGS = [
+    "HOG", "K-means clustering", "OpenCV", "Python", "SVM", "matplotlib",
+    "neural networks", "object detection", "yolo", "linear algebra",
+]
+LANGUAGES = ["python"] * 6 + ["bash", "plain", "cpp", "php"]
+WORDS = (
+    "the of a to in is we that for this with as on be are by it an image "
+    "function matrix vector point each value pixel frame model detection "
+    "window gradient kernel rotation transformation algorithm cluster "
+    "feature network layer output input using which can will from at"
+).split()
+
+
+def _sentence(rng: random.Random, min_words: int = 8, max_words: int = 20):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def _wrap(text: str, width: int = 80):
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    lines.append(line)
+    return lines
+
+
+def synthetic_post(
+    idx: int, post_fnames: list, images: list, rng: random.Random
+) -> str:
+    """
+    Return the text of a synthetic post whose length and shortcode mix are
+    roughly those of the posts in `content/blog`.
+    """
+    date = post_fnames[idx][:10]
+    slug = post_fnames[idx][11:-3]
+    title = " ".join(rng.choices(WORDS, k=6)).capitalize()
+
+    lines = [
+        "---",
+        f"title: {title} (part {idx})",
+        "author: Najam Syed",
+        "type: post",
+        f"date: {date}T12:00:00+00:00",
+        f"url: /{date.replace('-', '/')}/{slug}/",
+        "categories:",
+    ]
+    lines.extend(f"  - {c}" for c in rng.sample(CATEGORIES, 2))
+    lines.append("tags:")
+    lines.extend(f"  - {t}" for t in rng.sample(TAGS, 3))
+
+    katex = rng.random() < 0.4
+    if katex:
+        lines.append("katex: true")
+        lines.append('markup: "mmark"')
+    lines.extend(["", "---"])
+
+    refs = []
+    for section in range(rng.randint(3, 6)):
+        lines.append(f"# Section {section + 1}")
+        lines.append("")
+
+        for _ in range(rng.randint(2, 5)):
+            paragraph = " ".join(
+                _sentence(rng) for _ in range(rng.randint(2, 5))
+            )
+            if idx > 0 and rng.random() < 0.3:
+                ref_fname = post_fnames[rng.randrange(idx)]
+                refs.append(f'{{{{< ref "{ref_fname}" >}}}}')
+                paragraph += f" See [this post][{len(refs)}]."
+            lines.extend(_wrap(paragraph))
+            lines.append("")
+
+        if katex and rng.random() < 0.6:
+            lines.append("$$")
+            lines.append(r"\mathbf{R} = \begin{bmatrix} \cos\theta & "
+                r"-\sin\theta \\ \sin\theta & \cos\theta \end{bmatrix}")
+            lines.append("$$")
+            lines.append("")
+
+        if images and rng.random() < 0.7:
+            lines.append(f"{{{{< figure src=/img/{rng.choice(images)} >}}}}")
+            lines.append("")
+
+        if rng.random() < 0.8:
+            language = rng.choice(LANGUAGES)
+            lines.append(
+                f'{{{{< highlight {language} "linenos=true" >}}}}'
+            )
+            for i in range(rng.randint(5, 40)):
+                lines.append(f"    value_{i} = compute(frame, {i})")
+            lines.append("{{< / highlight >}}")
+            lines.append("")
+
+        if rng.random() < 0.05:
+            lines.append("{{< youtube fGkGRoiBtKg >}}")
+            lines.append("")
+
+    for i, ref in enumerate(refs, start=1):
+        lines.append(f"[{i}]: {ref}")
+
+    return "\n".join(lines) + "\n"
+
+
+def make_site(num_posts: int, site_dir: pathlib.Path, seed: int = 0):
+    """
+    Create a synthetic copy of the site with `num_posts` blog posts.
+    """
+    for item in SITE_ITEMS:
+        src = REPO_DIR / item
+        dst = site_dir / item
+        if src.is_dir():
+            ignore = None
+            if item == "content":
+                ignore = lambda d, names: (
+                    ["blog"] if pathlib.Path(d) == src else []
+                )
+            shutil.copytree(src, dst, ignore=ignore)
+        elif src.exists():
+            shutil.copy2(src, dst)
+
+    blog_dir = site_dir / "content" / "blog"
+    blog_dir.mkdir(parents=True)
+
+    rng = random.Random(seed)
+    images = sorted(
+        fpath.name for fpath in (REPO_DIR / "static" / "img").iterdir()
+    )
+
+    # Spread posts one per day starting in 2017 so dates (and URLs) are
+    # unique.
+    start = time.mktime((2017, 1, 1, 0, 0, 0, 0, 0, -1))
+    post_fnames = [
+        time.strftime("%Y-%m-%d", time.localtime(start + i * 86400))
+        + f"-synthetic-post-{i}.md"
+        for i in range(num_posts)
+    ]
+
+    for idx, fname in enumerate(post_fnames):
+        with open(blog_dir / fname, "w") as f:
+            f.write(synthetic_post(idx, post_fnames, images, rng))
+
+
+def dir_size(path: pathlib.Path) -> int:
+    """
+    Return the total size in bytes of the files under `path`.
+    """
+    if path.is_file():
+        return path.stat().st_size
+    return sum(
+        fpath.stat().st_size for fpath in path.rglob("*") if fpath.is_file()
+    )
+
+
+def run_stage(stage: str, site_dir: pathlib.Path):
+    """
+    Run a single pipeline stage against `site_dir`. Called in a subprocess
+    (see :func:`measure_stage`).
+    """
+    sys.path.insert(0, str(REPO_DIR))
+    sys.path.insert(0, str(REPO_DIR / "tools"))
+    import sitetools
+
+    os.chdir(site_dir)
+    secrets_fpath = site_dir / "secrets.txt.example"
+
+    if stage == "isso":
+        secrets = sitetools.read_secrets_file(secrets_fpath)
+        sitetools.decode_secrets(secrets)
+        sitetools.insert_isso_config_secrets(
+            site_dir / "isso.cfg.nosecrets", site_dir / "isso.cfg", secrets
+        )
+    elif stage == "build":
+        build_dir = sitetools.build_site(secrets_fpath)
+        sitetools.post_build(
+            build_dir,
+            image_index_fpath=site_dir / ".image-index.json",
+            cache_conf_fpath=site_dir / "cache-headers.conf",
+        )
+    elif stage == "format":
+        import format_posts
+        dst_dir = site_dir / "formatted"
+        dst_dir.mkdir(exist_ok=True)
+        for fpath in sorted((site_dir / "content" / "blog").iterdir()):
+            format_posts.format_post(fpath, dst_dir / fpath.name)
+    elif stage == "deploy":
+        sitetools.deploy_site(site_dir / "deploy", delete_existing=True)
+
+
+STAGE_OUTPUTS = {
+    "isso": "isso.cfg",
+    "build": "public",
+    "format": "formatted",
+    "deploy": "deploy",
+}
+
+
+def stage_profile_args(
+    profile_args: argparse.Namespace, num_posts: int, stage: str
+) -> list:
+    """
+    Return the profiling options (see :func:`instrument.add_arguments`) with
+    which to run a stage subprocess, given those of the benchmark.
+    """
+    if profile_args is None or not (
+        profile_args.profile or profile_args.trace_memory
+        or profile_args.profile_output
+    ):
+        return []
+
+    report_dir = (
+        profile_args.profile_output.parent if profile_args.profile_output
+        else pathlib.Path(".")
+    )
+    report_fpath = report_dir / f"bench_build.{num_posts}.{stage}.profile.json"
+
+    cmd_args = ["--profile-top", str(profile_args.profile_top)]
+    cmd_args += ["--profile-output", str(report_fpath.resolve())]
+    if profile_args.profile:
+        cmd_args.append("--profile")
+    if profile_args.trace_memory:
+        cmd_args.append("--trace-memory")
+    return cmd_args
+
+
+def measure_stage(
+    stage: str, site_dir: pathlib.Path, profile_cmd_args: list = ()
+) -> dict:
+    """
+    Run a stage in a fresh subprocess, with the command line options
+    `profile_cmd_args` (see :func:`stage_profile_args`), and return its wall
+    time, peak RSS, and output size.
+    """
+    cmd = [
+        sys.executable, __file__, "--run-stage", stage,
+        "--site-dir", str(site_dir), *profile_cmd_args,
+    ]
+
+    start_t = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    # wait4 reports the max RSS of the child and its own (waited) children,
+    # so hugo is included in the build stage's peak.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start_t
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    output = site_dir / STAGE_OUTPUTS[stage]
+    return {
+        "stage": stage,
+        "ok": proc.returncode == 0,
+        "wall_time_s": elapsed,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_bytes": rusage.ru_maxrss * 1024,
+        "output_bytes": dir_size(output) if output.exists() else 0,
+    }
+
+
+def benchmark(
+    sizes,
+    stages=STAGES,
+    seed: int = 0,
+    keep: bool = False,
+    profile_args: argparse.Namespace = None,
+):
+    """
+    Args:
+        sizes: Iterable of post counts for which to generate a site.
+        stages: Pipeline stages to run, in order.
+        seed: Random seed for the synthetic post generator.
+        keep: Keep the generated sites instead of deleting them.
+        profile_args: Parsed profiling options with which to profile each
+            stage subprocess (see :func:`stage_profile_args`).
+    Returns:
+        List of result dicts (see :func:`measure_stage`), each with the
+        additional keys "num_posts" and "content_bytes".
+    """
+    results = []
+    for num_posts in sizes:
+        site_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"bench_{num_posts}_"))
+        try:
+            make_site(num_posts, site_dir, seed=seed)
+            content_bytes = dir_size(site_dir / "content" / "blog")
+
+            for stage in stages:
+                result = measure_stage(
+                    stage, site_dir,
+                    stage_profile_args(profile_args, num_posts, stage),
+                )
+                result["num_posts"] = num_posts
+                result["content_bytes"] = content_bytes
+                results.append(result)
+
+                print(
+                    f"{num_posts:>6} posts  {stage:<7} "
+                    f"{'ok' if result['ok'] else 'FAILED':<6} "
+                    f"{result['wall_time_s']:>8.2f} s  "
+                    f"{result['peak_rss_bytes'] / 2**20:>8.1f} MiB  "
+                    f"{result['output_bytes'] / 2**20:>8.1f} MiB out"
+                )
+        finally:
+            if keep:
+                print(f"Kept {site_dir}")
+            else:
+                shutil.rmtree(site_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+        help="Numbers of posts for which to generate and build a site"
+    )
+    parser.add_argument(
+        "--stages", type=str, nargs="+", choices=STAGES, default=STAGES,
+        help="Pipeline stages to run"
+    )
+    parser.add_argument(
+        "-o", "--output", type=pathlib.Path, default=None,
+        help="Path to output JSON file of results"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the generated sites"
+    )
+    parser.add_argument("--run-stage", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--site-dir", type=pathlib.Path, help=argparse.SUPPRESS)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        with instrument.profile_run(args):
+            run_stage(args.run_stage, args.site_dir)
+    else:
+        with instrument.profile_run(args):
+            results = benchmark(
+                args.sizes, stages=args.stages, seed=args.seed,
+                keep=args.keep, profile_args=args,
+            )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
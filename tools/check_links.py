@@ -0,0 +1,455 @@
+"""
+Check the links in a built site (`public/`) for broken internal links,
+missing anchors, missing assets (e.g., `/img/...`), unresolved `ref`
+shortcodes, and dead external links.
+
+Pages are parsed in parallel across a process pool. Internal links are
+resolved against the build directory and the pages listed in the site's
+`sitemap.xml`. External links are checked concurrently with an asyncio HTTP
+client that pools connections, limits the number of simultaneous requests per
+host, and caches results on disk so that unchanged links are not rechecked
+until their cache entry expires. Failures that are likely transient (network
+errors, timeouts, 429s, and 5xx responses) expire from the cache sooner, and
+the cache is not used when requests are redirected with `--host-override`.
+"""
+import argparse
+import asyncio
+import json
+import pathlib
+import sys
+import time
+from typing import Dict, List, Set, Tuple
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import aiohttp
+import bs4
+
+import instrument
+import site_pages
+
+# Attributes that reference other resources, by tag.
+LINK_ATTRS = {
+    "a": ("href",),
+    "img": ("src",),
+    "link": ("href",),
+    "script": ("src",),
+    "source": ("src",),
+}
+
+
+@instrument.timed
+def parse_page(fpath: pathlib.Path) -> Tuple[List[str], Set[str]]:
+    """
+    Args:
+        fpath: Path to a built HTML page.
+    Returns:
+        Tuple of (list of linked URLs, set of element ids on the page).
+    """
+    with open(fpath, "r") as f:
+        soup = bs4.BeautifulSoup(f, "html.parser")
+
+    links = []
+    for tag_name, attrs in LINK_ATTRS.items():
+        for tag in soup.find_all(tag_name):
+            for attr in attrs:
+                url = tag.get(attr)
+                if url:
+                    links.append(url.strip())
+
+    ids = {tag["id"] for tag in soup.find_all(id=True)}
+    ids.update(tag["name"] for tag in soup.find_all("a", attrs={"name": True}))
+    return links, ids
+
+
+def read_sitemap(build_dir: pathlib.Path) -> Set[str]:
+    """
+    Return the set of URL paths listed in `sitemap.xml` (empty if the build
+    has no sitemap).
+    """
+    sitemap_fpath = build_dir / "sitemap.xml"
+    if not sitemap_fpath.exists():
+        return set()
+
+    ns = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+    root = ET.parse(sitemap_fpath).getroot()
+    return {
+        urllib.parse.urlsplit(loc.text.strip()).path
+        for loc in root.iter(f"{ns}loc")
+    }
+
+
+def resolve_internal(
+    path: str, build_dir: pathlib.Path, sitemap: Set[str]
+) -> pathlib.Path:
+    """
+    Map a (decoded) URL path to the file in `build_dir` that would serve it.
+    Returns `None` if no such file exists.
+    """
+    fpath = build_dir / path.lstrip("/")
+
+    if fpath.is_dir():
+        fpath = fpath / "index.html"
+    elif not fpath.exists() and not path.endswith("/"):
+        # Hugo serves `/post` as `/post/`.
+        if path + "/" in sitemap or (fpath / "index.html").exists():
+            fpath = fpath / "index.html"
+
+    return fpath if fpath.is_file() else None
+
+
+@instrument.timed
+def check_internal(
+    pages: Dict[str, Tuple[List[str], Set[str]]],
+    build_dir: pathlib.Path,
+) -> Tuple[List[Tuple[str, str, str]], Set[str]]:
+    """
+    Check internal links, anchors, and assets.
+
+    Args:
+        pages: Dict mapping page file path to (links, ids) as returned by
+            :func:`parse_page`.
+        build_dir: Path to the build directory.
+    Returns:
+        Tuple of (list of (page, url, error) tuples, set of external URLs
+        found on the pages).
+    """
+    sitemap = read_sitemap(build_dir)
+    ids_by_fpath = {
+        pathlib.Path(fpath).resolve(): ids
+        for fpath, (_, ids) in pages.items()
+    }
+
+    errors = []
+    external = set()
+
+    for fpath, (links, ids) in pages.items():
+        base = site_pages.base_path(pathlib.Path(fpath), build_dir)
+
+        for url in links:
+            if "REF_NOT_FOUND" in url:
+                errors.append((fpath, url, "unresolved ref shortcode"))
+                continue
+
+            parts = urllib.parse.urlsplit(url)
+            if not (parts.scheme or parts.netloc or parts.path):
+                # Same-page anchor.
+                if parts.fragment and parts.fragment not in ids:
+                    errors.append((fpath, url, "missing anchor"))
+                continue
+
+            classified = site_pages.classify_url(url, base)
+            if classified is None:
+                continue
+            kind, value = classified
+            if kind == "external":
+                external.add(value)
+                continue
+
+            target = resolve_internal(value, build_dir, sitemap)
+            if target is None:
+                errors.append((fpath, url, "not found"))
+                continue
+
+            if parts.fragment:
+                target_ids = ids_by_fpath.get(target.resolve())
+                if target_ids is not None and parts.fragment not in target_ids:
+                    errors.append((fpath, url, "missing anchor"))
+
+    return errors, external
+
+
+class LinkCache:
+    """
+    Persistent cache of external link check results, stored as JSON. Each
+    entry records the result and the time it was checked; entries older than
+    `max_age` seconds (`transient_max_age` seconds for likely transient
+    failures, see :meth:`is_transient`) are treated as missing.
+    """
+    def __init__(
+        self,
+        fpath: pathlib.Path,
+        max_age: float = 7 * 86400,
+        transient_max_age: float = 3600,
+    ):
+        self.fpath = pathlib.Path(fpath)
+        self.max_age = max_age
+        self.transient_max_age = transient_max_age
+        self.entries = {}
+
+        if self.fpath.exists():
+            with open(self.fpath, "r") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def is_transient(status: int) -> bool:
+        """
+        Whether a status (0 for a failed request) is likely to be a
+        temporary failure, e.g., a timeout or an overloaded server.
+        """
+        return status == 0 or status == 429 or status >= 500
+
+    def _expired(self, entry: dict, now: float) -> bool:
+        max_age = (
+            self.transient_max_age if self.is_transient(entry["status"])
+            else self.max_age
+        )
+        return now - entry["checked"] > max_age
+
+    def get(self, url: str):
+        entry = self.entries.get(url)
+        if entry is None or self._expired(entry, time.time()):
+            return None
+        return entry
+
+    def set(self, url: str, status: int, error: str = None):
+        self.entries[url] = {
+            "status": status, "error": error, "checked": time.time()
+        }
+
+    def save(self):
+        # Drop expired entries so the cache does not grow without bound.
+        now = time.time()
+        entries = {
+            url: entry for url, entry in self.entries.items()
+            if not self._expired(entry, now)
+        }
+        with open(self.fpath, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+
+
+def rewrite_url(url: str, host_overrides: Dict[str, str]) -> str:
+    """
+    Redirect a URL to a different base URL if its host is in
+    `host_overrides`, e.g., `{"github.com": "http://127.0.0.1:8000"}`. Used to
+    point external checks at a local stand-in server.
+    """
+    if not host_overrides:
+        return url
+
+    parts = urllib.parse.urlsplit(url)
+    override = host_overrides.get(parts.hostname, host_overrides.get("*"))
+    if override is None:
+        return url
+
+    base = urllib.parse.urlsplit(override)
+    return urllib.parse.urlunsplit(
+        (base.scheme, base.netloc, parts.path, parts.query, "")
+    )
+
+
+async def _check_url(
+    session: aiohttp.ClientSession,
+    semaphores: Dict[str, asyncio.Semaphore],
+    per_host: int,
+    url: str,
+    request_url: str,
+    timeout: float,
+) -> Tuple[str, int, str]:
+    host = urllib.parse.urlsplit(request_url).netloc
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(per_host)
+
+    # Wait for a per-host slot before starting the request so that time spent
+    # queued behind other requests to the same host does not count toward
+    # the request timeout.
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with semaphores[host]:
+        try:
+            async with session.head(
+                request_url, allow_redirects=True, timeout=client_timeout
+            ) as resp:
+                status = resp.status
+
+            # Some servers do not support HEAD; retry those with GET.
+            if status in (403, 405, 501):
+                async with session.get(
+                    request_url, allow_redirects=True, timeout=client_timeout
+                ) as resp:
+                    status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return url, 0, repr(e)
+
+    return url, status, None
+
+
+async def check_external(
+    urls: Set[str],
+    cache: LinkCache = None,
+    max_connections: int = 50,
+    per_host: int = 4,
+    timeout: float = 15,
+    host_overrides: Dict[str, str] = None,
+) -> Dict[str, Tuple[int, str]]:
+    """
+    Check external URLs concurrently.
+
+    Args:
+        urls: Set of absolute URLs to check.
+        cache: Optional :class:`LinkCache`; cached (unexpired) results are
+            reused and new results are added to it.
+        max_connections: Maximum number of pooled connections overall.
+        per_host: Maximum number of simultaneous requests to a single host.
+        timeout: Per-request timeout in seconds.
+        host_overrides: See :func:`rewrite_url`.
+    Returns:
+        Dict mapping each URL to (HTTP status, error). A status of 0 means the
+        request failed (see error).
+    """
+    results = {}
+    to_check = []
+    for url in sorted(urls):
+        entry = cache.get(url) if cache is not None else None
+        if entry is not None:
+            results[url] = (entry["status"], entry["error"])
+        else:
+            to_check.append(url)
+
+    connector = aiohttp.TCPConnector(
+        limit=max_connections, limit_per_host=per_host
+    )
+    headers = {"User-Agent": "nrsyed.com link checker"}
+    semaphores = {}
+
+    async with aiohttp.ClientSession(
+        connector=connector, headers=headers
+    ) as session:
+        tasks = [
+            _check_url(
+                session, semaphores, per_host, url,
+                rewrite_url(url, host_overrides), timeout
+            )
+            for url in to_check
+        ]
+        for coro in asyncio.as_completed(tasks):
+            url, status, error = await coro
+            results[url] = (status, error)
+            if cache is not None:
+                cache.set(url, status, error)
+
+    return results
+
+
+def check_site(
+    build_dir: pathlib.Path,
+    external: bool = True,
+    cache_fpath: pathlib.Path = None,
+    cache_max_age: float = 7 * 86400,
+    max_workers: int = None,
+    pool: instrument.ProcessPool = None,
+    **external_kwargs,
+) -> List[Tuple[str, str, str]]:
+    """
+    Check every HTML page in `build_dir`.
+
+    Args:
+        build_dir: Path to the build directory (e.g., `public`).
+        external: Whether to check external links.
+        cache_fpath: Path to the external link cache file; `None` to disable
+            caching. The cache is not used if `host_overrides` is given in
+            `external_kwargs`, since the results are those of the stand-in
+            servers rather than of the real URLs.
+        cache_max_age: Seconds after which cached results expire.
+        max_workers: Number of processes used to parse pages.
+        pool: Process pool to parse pages with instead of a new one.
+        external_kwargs: Passed to :func:`check_external`.
+    Returns:
+        List of (page, url, error) tuples, one per broken link.
+    """
+    build_dir = pathlib.Path(build_dir)
+
+    with instrument.span("check_links.parse_pages"):
+        pages = {
+            str(fpath): links_ids
+            for fpath, links_ids in site_pages.map_pages(
+                parse_page, build_dir, pool=pool, max_workers=max_workers
+            )
+        }
+
+    errors, external_urls = check_internal(pages, build_dir)
+
+    if external and external_urls:
+        cache = None
+        if (
+            cache_fpath is not None
+            and not external_kwargs.get("host_overrides")
+        ):
+            cache = LinkCache(cache_fpath, max_age=cache_max_age)
+
+        with instrument.span("check_links.check_external"):
+            results = asyncio.run(
+                check_external(external_urls, cache=cache, **external_kwargs)
+            )
+
+        if cache is not None:
+            cache.save()
+
+        bad_urls = {
+            url: (error or f"HTTP {status}")
+            for url, (status, error) in results.items()
+            if status == 0 or status >= 400
+        }
+        for fpath, (links, _) in pages.items():
+            for url in links:
+                normalized = site_pages.external_url(url)
+                if normalized in bad_urls:
+                    errors.append((fpath, url, bad_urls[normalized]))
+
+    return sorted(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "build_dir", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument(
+        "--no-external", action="store_true",
+        help="Only check internal links and assets"
+    )
+    parser.add_argument(
+        "--cache", type=pathlib.Path, default=".linkcheck.json",
+        help="Path to external link result cache (not used with "
+            "--host-override)"
+    )
+    parser.add_argument(
+        "--cache-max-age", type=float, default=7 * 86400,
+        help="Seconds before a cached external link result expires"
+    )
+    parser.add_argument(
+        "--per-host", type=int, default=4,
+        help="Maximum simultaneous requests per external host"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=15,
+        help="Timeout (seconds) for each external request"
+    )
+    parser.add_argument(
+        "--host-override", type=str, action="append", default=[],
+        metavar="HOST=BASE_URL",
+        help="Send requests for HOST (or * for all hosts) to BASE_URL, "
+            "e.g., a local stand-in server; may be repeated"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    host_overrides = dict(
+        override.split("=", 1) for override in args.host_override
+    )
+
+    with instrument.profile_run(args):
+        errors = check_site(
+            args.build_dir,
+            external=not args.no_external,
+            cache_fpath=args.cache,
+            cache_max_age=args.cache_max_age,
+            per_host=args.per_host,
+            timeout=args.timeout,
+            host_overrides=host_overrides,
+        )
+
+    for fpath, url, error in errors:
+        print(f"{fpath}: {url} ({error})")
+    print(f"{len(errors)} broken link(s)")
+    sys.exit(1 if errors else 0)
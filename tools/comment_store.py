@@ -0,0 +1,201 @@
+"""
+Indexed SQLite store for the WordPress comments being migrated to Isso.
+
+The comment workflow (`xmlread.py` -> `editable_comments.py` ->
+`import_comments.py`) reads and updates this store in place instead of
+passing a single `posts.json` between steps, so looking up or editing a
+comment is a point query rather than a load/rewrite of the whole export.
+
+Schema:
+    posts(post_id, post_name, title)
+    comments(comment_id, post_id, comment_parent, comment_content, fields)
+
+`comment_parent` is 0 for top-level comments. `fields` holds the remaining
+WordPress comment fields (author, dates, etc.) as JSON. Comments are indexed
+by post and by parent, so a post's comment tree is fetched with an indexed
+recursive query (see :func:`get_thread`).
+"""
+import json
+import pathlib
+import sqlite3
+from typing import Iterable, Iterator, List
+
+
+SCHEMA = """
+create table if not exists posts (
+    post_id integer primary key,
+    post_name text,
+    title text
+);
+create table if not exists comments (
+    comment_id integer primary key,
+    post_id integer not null references posts(post_id),
+    comment_parent integer not null default 0,
+    comment_content text,
+    fields text not null default '{}'
+);
+create index if not exists comments_post_parent
+    on comments(post_id, comment_parent);
+create index if not exists comments_parent on comments(comment_parent);
+"""
+
+# Keys of a WordPress comment dict (see `xmlread.parse`) stored as columns.
+COLUMNS = ("comment_id", "comment_parent", "comment_content")
+
+
+def open_store(store_path: pathlib.Path) -> sqlite3.Connection:
+    """
+    Open (creating if necessary) the comment store at `store_path`.
+    """
+    conn = sqlite3.connect(store_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _row_to_comment(row: sqlite3.Row) -> dict:
+    """
+    Convert a comments row to a dict with the same keys (and string values)
+    as the comment dicts produced by `xmlread.parse`.
+    """
+    comment = json.loads(row["fields"])
+    comment["comment_id"] = str(row["comment_id"])
+    comment["comment_parent"] = str(row["comment_parent"])
+    comment["comment_content"] = row["comment_content"]
+    return comment
+
+
+def add_post(conn: sqlite3.Connection, post: dict):
+    """
+    Insert or replace a post and its comments. `post` is a dict as produced by
+    `xmlread.parse` (with a "comments" list).
+    """
+    post_id = int(post["post_id"])
+    conn.execute(
+        "insert or replace into posts (post_id, post_name, title)"
+        " values (?, ?, ?)",
+        (post_id, post["post_name"], post["title"]),
+    )
+    conn.executemany(
+        "insert or replace into comments"
+        " (comment_id, post_id, comment_parent, comment_content, fields)"
+        " values (?, ?, ?, ?, ?)",
+        (
+            (
+                int(comment["comment_id"]),
+                post_id,
+                int(comment.get("comment_parent") or 0),
+                comment.get("comment_content"),
+                json.dumps({
+                    k: v for k, v in comment.items() if k not in COLUMNS
+                }),
+            )
+            for comment in post["comments"]
+        ),
+    )
+
+
+def add_posts(conn: sqlite3.Connection, posts: Iterable[dict]):
+    """
+    Add posts (e.g., streamed from `xmlread.iter_posts`) in one transaction.
+    """
+    with conn:
+        for post in posts:
+            add_post(conn, post)
+
+
+def iter_posts(conn: sqlite3.Connection) -> Iterator[dict]:
+    """
+    Yield each post (without its comments) as a dict with keys "post_id",
+    "post_name", and "title".
+    """
+    for row in conn.execute(
+        "select post_id, post_name, title from posts order by post_id"
+    ):
+        yield {
+            "post_id": str(row["post_id"]),
+            "post_name": row["post_name"],
+            "title": row["title"],
+        }
+
+
+def iter_comments(conn: sqlite3.Connection) -> Iterator[dict]:
+    for row in conn.execute("select * from comments order by comment_id"):
+        yield _row_to_comment(row)
+
+
+def get_comment(conn: sqlite3.Connection, comment_id: int) -> dict:
+    row = conn.execute(
+        "select * from comments where comment_id = ?", (int(comment_id),)
+    ).fetchone()
+    if row is None:
+        raise KeyError(comment_id)
+    return _row_to_comment(row)
+
+
+def update_comment_content(
+    conn: sqlite3.Connection, comment_id: int, comment_content: str
+):
+    cursor = conn.execute(
+        "update comments set comment_content = ? where comment_id = ?",
+        (comment_content, int(comment_id)),
+    )
+    if cursor.rowcount == 0:
+        raise KeyError(comment_id)
+
+
+def get_thread(conn: sqlite3.Connection, post_id: int) -> List[dict]:
+    """
+    Return the comments on a post as a tree: a list of the top-level comments,
+    each with a "replies" list of its replies (recursively).
+    """
+    rows = conn.execute(
+        """
+        with recursive thread(comment_id, depth) as (
+            select comment_id, 0 from comments
+            where post_id = ? and comment_parent = 0
+            union all
+            select comments.comment_id, thread.depth + 1
+            from comments join thread
+                on comments.comment_parent = thread.comment_id
+        )
+        select comments.* from thread
+        join comments on comments.comment_id = thread.comment_id
+        order by thread.depth, comments.comment_id
+        """,
+        (int(post_id),),
+    )
+
+    top_level = []
+    comment_id_to_comment = {}
+    for row in rows:
+        comment = _row_to_comment(row)
+        comment["replies"] = []
+        comment_id_to_comment[row["comment_id"]] = comment
+
+        parent = comment_id_to_comment.get(row["comment_parent"])
+        if parent is None:
+            top_level.append(comment)
+        else:
+            parent["replies"].append(comment)
+    return top_level
+
+
+def export_json(conn: sqlite3.Connection, json_path: pathlib.Path):
+    """
+    Write the store in the layout of the old `posts.json` (a list of posts,
+    each with a flat "comments" list).
+    """
+    posts = []
+    for post in iter_posts(conn):
+        post["comments"] = [
+            _row_to_comment(row) for row in conn.execute(
+                "select * from comments where post_id = ?"
+                " order by comment_id",
+                (int(post["post_id"]),),
+            )
+        ]
+        posts.append(post)
+
+    with open(json_path, "w") as f:
+        json.dump(posts, f, indent=2)
@@ -2,55 +2,47 @@
 This simple script has a function that writes the comment content of each
 comment to a text file. This makes it easier to see the formatting of the
 post (e.g., newlines) and edit the comments (e.g., adding backticks around code
-blocks). A second function is then used to update the content of the original
-JSON file by reading the updated comment files.
+blocks). A second function is then used to update the content of the
+comments in the comment store by reading the updated comment files.
 """
-import json
+import argparse
 import os
 
+import comment_store
+import instrument
 
-def write_editable(src_path, dst_dir):
+
+@instrument.timed
+def write_editable(store_path, dst_dir):
     """
     Args:
-        src_path (str): Path to post data JSON file.
+        store_path (str): Path to comment store (see :mod:`comment_store`).
         dst_dir (str): Path to directory where the editable .md files (one
             per comment) will be written. Each file will be named
             <comment_id>.md.
     """
-    with open(src_path, "r") as f:
-        posts = json.load(f)
+    conn = comment_store.open_store(store_path)
 
-    editable_posts = []
+    for comment in comment_store.iter_comments(conn):
+        comment_id = comment["comment_id"]
+        comment_content = comment["comment_content"]
 
-    for post in posts:
-        for comment in post["comments"]:
-            comment_id = comment["comment_id"]
-            comment_content = comment["comment_content"]
+        dst_path = os.path.join(dst_dir, f"{comment_id}.md")
+        with open(dst_path, "w") as f:
+            f.write(comment_content)
 
-            dst_path = os.path.join(dst_dir, f"{comment_id}.md")
-            with open(dst_path, "w") as f:
-                f.write(comment_content)
+    conn.close()
 
 
-def editable_to_json(src_path, editable_path, dst_path):
+@instrument.timed
+def editable_to_store(store_path, editable_path):
     """
     Args:
-        src_path (str): Path to post data JSON file.
+        store_path (str): Path to comment store (see :mod:`comment_store`).
         editable_path (str): Path to editable .md file or directory of
-            .md files.
-        dst_path (str): Path to updated JSON file (ie, a copy of `src_path`
-            with the comment content updated to match the .md file(s) at
-            `editable_path`).
+            .md files. The content of each corresponding comment in the store
+            is updated in place to match its file.
     """
-    with open(src_path, "r") as f:
-        posts = json.load(f)
-
-    # Create a mapping between comment ids and comments.
-    comment_id_to_comment = {
-        int(comment["comment_id"]): comment
-        for post in posts for comment in post["comments"]
-    }
-
     if os.path.isfile(editable_path):
         editable_fpaths = [editable_path]
     else:
@@ -59,26 +51,43 @@ def editable_to_json(src_path, editable_path, dst_path):
             for fname in os.listdir(editable_path)
         ]
 
-    for fpath in editable_fpaths:
-        _, fname = os.path.split(fpath)
-        comment_id = int(os.path.splitext(fname)[0])
-        with open(fpath, "r") as f:
-            comment_content = f.read()
+    conn = comment_store.open_store(store_path)
 
-        comment = comment_id_to_comment[comment_id]
-        comment["comment_content"] = comment_content
+    with conn:
+        for fpath in editable_fpaths:
+            _, fname = os.path.split(fpath)
+            comment_id = int(os.path.splitext(fname)[0])
+            with open(fpath, "r") as f:
+                comment_content = f.read()
 
-    with open(dst_path, "w") as f:
-        json.dump(posts, f, indent=2)
+            comment_store.update_comment_content(
+                conn, comment_id, comment_content
+            )
 
+    conn.close()
 
-if __name__ == "__main__":
-    json_path = "posts.json"
-    editable_dir = "editable"
-
-    if not os.path.exists(editable_dir):
-        os.makedirs(editable_dir)
 
-    # write_editable(json_path, editable_dir)
-    updated_json_path = "updated_posts.json"
-    editable_to_json(json_path, editable_dir, updated_json_path) 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--store", default="comments_store.db",
+        help="Path to comment store"
+    )
+    parser.add_argument(
+        "--editable", default="editable",
+        help="Editable .md file or directory of .md files"
+    )
+    parser.add_argument(
+        "--write", action="store_true",
+        help="Write the editable files instead of reading them back"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        if args.write:
+            if not os.path.exists(args.editable):
+                os.makedirs(args.editable)
+            write_editable(args.store, args.editable)
+        else:
+            editable_to_store(args.store, args.editable)
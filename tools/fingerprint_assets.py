@@ -0,0 +1,305 @@
+"""
+Post-build stage that fingerprints static assets in a built site.
+
+Each image/icon in the build directory (e.g., `public/img/*`, the favicons,
+and the project GIFs), font, script, and stylesheet is copied to a
+content-hashed filename such as `img/rotation_1.3f2a9c81d0.png`, and every
+reference to it in the generated HTML, CSS, and `site.webmanifest` is
+rewritten to the hashed name. In HTML, only the URL-bearing attributes of
+tags (`src`, `href`, `srcset`, `poster`, and `url()`s in `style`) and inline
+`<style>` blocks are rewritten, so text that merely looks like an asset path
+(e.g., a code sample) is left alone. Stylesheets are fingerprinted last,
+after the references in them (e.g., to fonts) have been rewritten, so their
+hashes reflect their final content. Since a fingerprinted file's content never
+changes, it can be served with an immutable, year-long `Cache-Control` header;
+an Apache config fragment that does this is written alongside.
+
+The original files are kept so that URLs fetched directly (e.g.,
+`/favicon.ico`) or linked from elsewhere keep working.
+"""
+import argparse
+import functools
+import hashlib
+import pathlib
+import re
+import shutil
+from typing import Dict
+import urllib.parse
+
+import instrument
+import site_pages
+
+
+IMAGE_EXTS = ("png", "jpg", "jpeg", "gif", "svg", "webp", "ico")
+FONT_EXTS = ("woff2", "woff", "ttf", "otf")
+STATIC_EXTS = IMAGE_EXTS + FONT_EXTS + ("js",)
+ASSET_EXTS = STATIC_EXTS + ("css",)
+REWRITE_SUFFIXES = (".html", ".css", ".webmanifest")
+HASH_LEN = 10
+
+# Already-fingerprinted filenames: ours (e.g., `name.3f2a9c81d0.png`) or
+# Hugo's (`resources.Fingerprint`, a 64-character SHA-256).
+FINGERPRINT_PATTERN = rf"\.(?:[0-9a-f]{{{HASH_LEN}}}|[0-9a-f]{{64}})"
+FINGERPRINTED_RE = re.compile(
+    rf"{FINGERPRINT_PATTERN}\.(?:{'|'.join(ASSET_EXTS)})$"
+)
+
+# Candidate asset URLs in CSS `url()` and `@import`, and JSON strings (used
+# for stylesheets and `site.webmanifest`, not HTML).
+ASSET_URL_RE = re.compile(
+    r"""(?<=["'(=])([^\s"'()<>,]+\.(?:"""
+    + "|".join(ASSET_EXTS)
+    + r"""))(?=[?#"')\s>,])""",
+    re.IGNORECASE,
+)
+
+# HTML attributes holding a single URL, or a `srcset` list of URLs.
+URL_ATTRS = ("src", "href", "poster")
+SRCSET_ATTRS = ("srcset",)
+
+# An attribute in a raw start tag, e.g., ` src="/img/a.png"`.
+TAG_ATTR_RE = re.compile(
+    r"""(?<=\s)([^\s"'>/=]+)(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'=<>`]+)"""
+)
+
+# A `url()` in a `style` attribute or `<style>` block; quotes may be
+# written as `&quot;` in attributes.
+STYLE_URL_RE = re.compile(
+    r"""(url\(\s*(?:&quot;|["'])?)([^"'()&\s]+)((?:&quot;|["'])?\s*\))"""
+)
+
+# A candidate in a `srcset` list, e.g., `/img/a.png 2x`.
+SRCSET_URL_RE = re.compile(r"(^|,)(\s*)([^\s,]+)")
+
+CACHE_CONF_TEMPLATE = """\
+# Generated by tools/fingerprint_assets.py. Fingerprinted assets never change
+# content, so they can be cached by browsers for a year without revalidation.
+<IfModule mod_headers.c>
+    <FilesMatch "{pattern}\\.({exts})$">
+        Header set Cache-Control "public, max-age=31536000, immutable"
+    </FilesMatch>
+</IfModule>
+"""
+
+
+def file_hash(fpath: pathlib.Path, length: int = HASH_LEN) -> str:
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        while chunk := f.read(1 << 16):
+            h.update(chunk)
+    return h.hexdigest()[:length]
+
+
+@instrument.timed
+def fingerprint_files(
+    build_dir: pathlib.Path, exts=ASSET_EXTS
+) -> Dict[str, str]:
+    """
+    Copy each asset in `build_dir` with one of the extensions `exts` to a
+    content-hashed filename.
+
+    Returns:
+        Dict mapping each asset's URL path (e.g., `/img/rotation_1.png`) to
+        its fingerprinted URL path (e.g., `/img/rotation_1.3f2a9c81d0.png`).
+    """
+    mapping = {}
+    for fpath in sorted(build_dir.rglob("*")):
+        if (
+            not fpath.is_file()
+            or fpath.suffix.lower().lstrip(".") not in exts
+            or FINGERPRINTED_RE.search(fpath.name)
+        ):
+            continue
+
+        hashed_fpath = fpath.with_name(
+            f"{fpath.stem}.{file_hash(fpath)}{fpath.suffix}"
+        )
+        shutil.copy2(fpath, hashed_fpath)
+
+        url_path = "/" + fpath.relative_to(build_dir).as_posix()
+        hashed_url_path = "/" + hashed_fpath.relative_to(build_dir).as_posix()
+        mapping[url_path] = hashed_url_path
+    return mapping
+
+
+def rewrite_url(url: str, base_path: str, mapping: Dict[str, str]) -> str:
+    """
+    Return `url` with its filename replaced by the fingerprinted filename if
+    it refers to a fingerprinted asset (relative URLs are resolved against
+    `base_path`); otherwise return `url` unchanged.
+    """
+    hashed_path = mapping.get(site_pages.local_path(url, base_path))
+    if hashed_path is None:
+        return url
+
+    parts = urllib.parse.urlsplit(url)
+
+    # Only the filename changes, so keep the URL in its original (absolute or
+    # relative) form.
+    head, sep, _ = parts.path.rpartition("/")
+    new_path = head + sep + hashed_path.rpartition("/")[2]
+    return urllib.parse.urlunsplit(parts._replace(path=new_path))
+
+
+def rewrite_style(css: str, base_path: str, mapping: Dict[str, str]) -> str:
+    return STYLE_URL_RE.sub(
+        lambda match: match.group(1)
+        + rewrite_url(match.group(2), base_path, mapping)
+        + match.group(3),
+        css,
+    )
+
+
+def rewrite_tag(tag: str, base_path: str, mapping: Dict[str, str]) -> str:
+    """
+    Rewrite the asset URLs in the attributes of a raw HTML start tag.
+    """
+    def _rewrite_attr(match):
+        name, equals, value = match.groups()
+        name = name.lower()
+        quote = value[0] if value[0] in "\"'" else ""
+        inner = value[1:-1] if quote else value
+
+        if name in URL_ATTRS:
+            inner = rewrite_url(inner, base_path, mapping)
+        elif name in SRCSET_ATTRS:
+            inner = SRCSET_URL_RE.sub(
+                lambda m: m.group(1) + m.group(2)
+                + rewrite_url(m.group(3), base_path, mapping),
+                inner,
+            )
+        elif name == "style":
+            inner = rewrite_style(inner, base_path, mapping)
+        else:
+            return match.group(0)
+        return f"{match.group(1)}{equals}{quote}{inner}{quote}"
+
+    return TAG_ATTR_RE.sub(_rewrite_attr, tag)
+
+
+def rewrite_html(text: str, base_path: str, mapping: Dict[str, str]) -> str:
+    """
+    Return an HTML document with the asset URLs in its tags' attributes and
+    `<style>` blocks rewritten; everything else is unchanged.
+    """
+    return site_pages.rewrite_tags(
+        text,
+        lambda tag, attrs, raw: rewrite_tag(raw, base_path, mapping),
+        rewrite_style=lambda css: rewrite_style(css, base_path, mapping),
+    )
+
+
+@instrument.timed
+def rewrite_file(
+    fpath: pathlib.Path, build_dir: pathlib.Path, mapping: Dict[str, str]
+) -> bool:
+    """
+    Rewrite the asset references in a single file. Returns whether the file
+    was changed.
+    """
+    base_path = site_pages.base_path(fpath, build_dir)
+
+    with open(fpath, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    if fpath.suffix == ".html":
+        updated_text = rewrite_html(text, base_path, mapping)
+    else:
+        updated_text = ASSET_URL_RE.sub(
+            lambda match: rewrite_url(match.group(1), base_path, mapping),
+            text,
+        )
+
+    if updated_text == text:
+        return False
+
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write(updated_text)
+    return True
+
+
+def write_cache_conf(conf_fpath: pathlib.Path):
+    """
+    Write an Apache config fragment that sets immutable, year-long cache
+    headers on fingerprinted assets. Include it from the site's vhost config
+    (or copy it into an `.htaccess` file).
+    """
+    with open(conf_fpath, "w") as f:
+        f.write(
+            CACHE_CONF_TEMPLATE.format(
+                pattern=FINGERPRINT_PATTERN,
+                exts="|".join(ASSET_EXTS),
+            )
+        )
+
+
+@instrument.timed
+def fingerprint_assets(
+    build_dir: pathlib.Path,
+    conf_fpath: pathlib.Path = None,
+    max_workers: int = None,
+    pool: instrument.ProcessPool = None,
+) -> Dict[str, str]:
+    """
+    Fingerprint the assets in `build_dir` and rewrite all references to them.
+
+    Args:
+        build_dir: Path to the built site (e.g., `public`).
+        conf_fpath: Path to which the cache header config fragment is
+            written; `None` to skip.
+        max_workers: Number of processes used to rewrite files.
+        pool: Process pool to rewrite files with instead of a new one.
+    Returns:
+        Dict mapping original to fingerprinted URL paths (see
+        :func:`fingerprint_files`).
+    """
+    build_dir = pathlib.Path(build_dir)
+
+    def _rewrite(fpaths, mapping):
+        rewrite = functools.partial(
+            rewrite_file, build_dir=build_dir, mapping=mapping
+        )
+        with instrument.span("fingerprint_assets.rewrite"), \
+                instrument.process_pool(pool, max_workers) as rewrite_pool:
+            return sum(rewrite_pool.map(rewrite, fpaths, chunksize=16))
+
+    fpaths = sorted(
+        fpath for fpath in build_dir.rglob("*")
+        if fpath.suffix in REWRITE_SUFFIXES and fpath.is_file()
+        and not FINGERPRINTED_RE.search(fpath.name)
+    )
+    css_fpaths = [fpath for fpath in fpaths if fpath.suffix == ".css"]
+    other_fpaths = [fpath for fpath in fpaths if fpath.suffix != ".css"]
+
+    # Stylesheets reference fonts and images, so rewrite them before hashing
+    # them; then rewrite everything else with the full mapping.
+    mapping = fingerprint_files(build_dir, exts=STATIC_EXTS)
+    num_rewritten = _rewrite(css_fpaths, mapping)
+    mapping.update(fingerprint_files(build_dir, exts=("css",)))
+    num_rewritten += _rewrite(other_fpaths, mapping)
+
+    if conf_fpath is not None:
+        write_cache_conf(conf_fpath)
+
+    print(
+        f"Fingerprinted {len(mapping)} assets; "
+        f"rewrote {num_rewritten}/{len(fpaths)} files"
+    )
+    return mapping
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "build_dir", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument(
+        "--cache-conf", type=pathlib.Path, default="cache-headers.conf",
+        help="Path to output Apache cache header config fragment"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        fingerprint_assets(args.build_dir, conf_fpath=args.cache_conf)
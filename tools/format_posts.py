@@ -16,6 +16,8 @@ import time
 import bs4
 import pyparsing as pp
 
+import instrument
+
 
 def get_grammar():
     punctuation = pp.Word(".,:;()/")
@@ -57,6 +59,7 @@ def get_grammar():
     return cfg
 
 
+@instrument.timed
 def split_line(line, max_len=80):
     """
     TODO
@@ -83,19 +86,38 @@ def split_line(line, max_len=80):
 
 
 def ref_shortcode_from_domain_url(url):
-    expr = "https://nrsyed\.com/(.*)(/|#.*)$"
+    """
+    Return a Hugo ref shortcode for a link to a post on the domain, e.g.,
+    `https://nrsyed.com/2018/05/06/post/#part` ->
+    `{{< ref "2018-05-06-post.md#part" >}}`. Links to uploads are pointed at
+    the same file in `/img/` (see the `<img>` handling in
+    :func:`format_lines`); other URLs on the domain that are not posts (e.g.,
+    category pages) are returned unchanged.
+    """
+    upload_match = re.match(
+        r"https?://(?:www\.)?nrsyed\.com/wp-content/uploads/.*/([^/]+)$", url
+    )
+    if upload_match:
+        return f"/img/{upload_match.group(1)}"
+
+    expr = (
+        r"https?://(?:www\.)?nrsyed\.com/(\d{4}/\d{2}/\d{2}/[^/#]+)/?(#.*)?$"
+    )
     match = re.match(expr, url)
+    if match is None:
+        return url
 
     url, anchor = match.groups()
     ref = url.replace("/", "-") + ".md"
 
-    if anchor.startswith("#"):
+    if anchor:
         ref += anchor
 
     shortcode = f'{{{{< ref "{ref}" >}}}}'
     return shortcode
 
 
+@instrument.timed
 def format_hyperlinks(markdown):
     open_tags = re.finditer(r"<a", markdown)
     close_tags = re.finditer(r"</a>", markdown)
@@ -139,39 +161,48 @@ def format_hyperlinks(markdown):
     return updated_markdown
 
 
-def format_file(fpath, max_line_len=80):
-    formatted_lines = []
-
+@instrument.timed
+def format_lines(lines, max_line_len=80):
+    """
+    Apply the formatting fixes to the lines of an exported post.
+
+    Args:
+        lines: Iterable of the lines (header and body) of a post, e.g., an
+            open file object.
+        max_line_len (int): Maximum length of a body line; longer lines are
+            split at token boundaries.
+    Returns:
+        The formatted post as a single string.
+    """
     # Extract header from post body and do some preprocessing.
     header = []
     body = []
-    with open(fpath, "r") as f:
-        header_delimiter_count = 0
-        for line in f:
-            # Remove trailing whitespace/newline.
-            line = line.rstrip()
-            if header_delimiter_count >= 2:
-                # Replace special characters with html code; pyparsing does not
-                # correctly parse these and truncates paragraphs where they
-                # appear. We address this here instead of in the grammar.
-                line = line.replace("–", "&#8211;")
-                line = line.replace("—", "&#8212;")
-                line = line.replace("°", "&#176;")
-                line = line.replace("θ", "&theta;")
-                line = line.replace("Δ", "&Delta;")
-                line = line.replace("\xa0", " ")
-                line = line.replace("º", "&#176;")
-
-                # Replace LaTeX start/end and subscript characters.
-                line = line.replace("\\(", "$$")
-                line = line.replace("\\)", "$$")
-                line = line.replace("\\_", "_")
-                body.append(line)
-            else:
-                # Header is enclosed by "---" at beginning and end.
-                if line == "---":
-                    header_delimiter_count += 1
-                header.append(line)
+    header_delimiter_count = 0
+    for line in lines:
+        # Remove trailing whitespace/newline.
+        line = line.rstrip()
+        if header_delimiter_count >= 2:
+            # Replace special characters with html code; pyparsing does not
+            # correctly parse these and truncates paragraphs where they
+            # appear. We address this here instead of in the grammar.
+            line = line.replace("–", "&#8211;")
+            line = line.replace("—", "&#8212;")
+            line = line.replace("°", "&#176;")
+            line = line.replace("θ", "&theta;")
+            line = line.replace("Δ", "&Delta;")
+            line = line.replace("\xa0", " ")
+            line = line.replace("º", "&#176;")
+
+            # Replace LaTeX start/end and subscript characters.
+            line = line.replace("\\(", "$$")
+            line = line.replace("\\)", "$$")
+            line = line.replace("\\_", "_")
+            body.append(line)
+        else:
+            # Header is enclosed by "---" at beginning and end.
+            if line == "---":
+                header_delimiter_count += 1
+            header.append(line)
 
     # In some places, the converter has put the <pre> tag of the start of a
     # code block at the end of the last paragraph and added newlines before
@@ -215,6 +246,12 @@ def format_file(fpath, max_line_len=80):
                             _body.append(line)
                 else:
                     raise RuntimeError("Unexpected text following <pre> tag")
+        elif pre_tag_re is not None and "</pre>" not in line:
+            # Keep the indentation of the lines of a code block.
+            _body.append(line)
+            while "</pre>" not in body[i]:
+                i += 1
+                _body.append(body[i])
         else:
             _body.append(line)
 
@@ -307,6 +344,11 @@ def format_file(fpath, max_line_len=80):
     return formatted_post
 
 
+def format_file(fpath, max_line_len=80):
+    with open(fpath, "r") as f:
+        return format_lines(f, max_line_len=max_line_len)
+
+
 def format_post(src_fpath, dst_fpath):
     formatted_text = format_file(src_fpath)
     with open(dst_fpath, "w") as f:
@@ -321,6 +363,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "dst", type=str, help="Destination markdown file or directory"
     )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
     if "*" in args.src:
@@ -340,10 +383,11 @@ if __name__ == "__main__":
             dst_fpaths = [args.dst]
 
     start_t = time.time()
-    pool = ThreadPoolExecutor()
-    for src_fpath, dst_fpath in zip(src_fpaths, dst_fpaths):
-        format_post(src_fpath, dst_fpath)
-        #pool.submit(format_post, src_fpath, dst_fpath)
-    pool.shutdown()
+    with instrument.profile_run(args):
+        pool = ThreadPoolExecutor()
+        for src_fpath, dst_fpath in zip(src_fpaths, dst_fpaths):
+            format_post(src_fpath, dst_fpath)
+            #pool.submit(format_post, src_fpath, dst_fpath)
+        pool.shutdown()
     elapsed = time.time() - start_t
     print(f"Elapsed: {elapsed}")
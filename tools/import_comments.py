@@ -1,30 +1,12 @@
+import argparse
 import datetime
-import json
 import os
 import re
 import sqlite3
 
-
-def nest_comments(posts):
-    _posts = []
-
-    for post in posts:
-        if post["comments"]:
-            comment_id_to_comment = dict()
-
-            for comment in post["comments"]:
-                comment["replies"] = []
-                comment_id = int(comment["comment_id"])
-                comment_id_to_comment[comment_id] = comment
-
-            for comment in post["comments"]:
-                parent_id = int(comment["comment_parent"])
-                if parent_id != 0:
-                    parent = comment_id_to_comment[parent_id]
-                    parent["replies"].append(comment)
-
-            _posts.append(post)
-    return _posts
+import comment_store
+import instrument
+import maintain_comments_db
 
 
 def insert_replies(cursor, thread_id, parent_id, comment):
@@ -59,7 +41,20 @@ def insert_replies(cursor, thread_id, parent_id, comment):
         insert_replies(cursor, thread_id, inserted_comment_id, reply)
 
 
-def import_into_db(db_path, json_path, hugo_posts_dir):
+@instrument.timed
+def import_into_db(db_path, store_path, hugo_posts_dir):
+    """
+    Args:
+        db_path (str): Path to Isso comments database.
+        store_path (str): Path to comment store (see :mod:`comment_store`).
+        hugo_posts_dir (str): Path to the Hugo posts, used to map each post
+            name to its URI (the Isso thread URI).
+
+    Since Isso is not serving the database during an import, the
+    `comments` table is rebuilt with a typed `tid` column if needed, then
+    the indexes Isso's per-thread queries need are created (see
+    :mod:`maintain_comments_db`) and the database is analyzed.
+    """
     post_name_to_uri = dict()
 
     expr = "(\d{4}-\d{2}-\d{2}-)(.*)\.md"
@@ -69,14 +64,17 @@ def import_into_db(db_path, json_path, hugo_posts_dir):
         uri = f"/{uri_date.replace('-', '/')}{post_name}/"
         post_name_to_uri[post_name] = uri
 
-    with open(json_path, "r") as f:
-        posts = json.load(f)
-
-    posts = nest_comments(posts)
+    store = comment_store.open_store(store_path)
 
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
-    for post in posts:
+    for post in comment_store.iter_posts(store):
+        # Fetch the post's comments as a tree (top-level comments with nested
+        # replies) with an indexed query on the store.
+        comments = comment_store.get_thread(store, post["post_id"])
+        if not comments:
+            continue
+
         uri = post_name_to_uri[post["post_name"]]
 
         # Check if thread for this post already exists. Create if not.
@@ -91,19 +89,30 @@ def import_into_db(db_path, json_path, hugo_posts_dir):
             )
             thread_id = c.lastrowid
 
-        for comment in post["comments"]:
-            comment_wp_id = int(comment["comment_parent"])
-            if comment_wp_id == 0:
-                # Only call function on top-level comments (not replies to
-                # other comments). Function will recursively insert children.
-                insert_replies(c, thread_id, None, comment)
+        # Only call function on top-level comments (not replies to other
+        # comments). Function will recursively insert children.
+        for comment in comments:
+            insert_replies(c, thread_id, None, comment)
+
+    conn.commit()
 
+    maintain_comments_db.retype_tid(conn)
+    maintain_comments_db.ensure_indexes(conn)
+    conn.execute("analyze")
     conn.commit()
 
+    conn.close()
+    store.close()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
     db_path = "comments.db"
-    json_path = "posts.json"
+    store_path = "comments_store.db"
     hugo_posts_dir = "/home/najam/nrsyed.com/content/blog"
 
-    import_into_db(db_path, json_path, hugo_posts_dir)
+    with instrument.profile_run(args):
+        import_into_db(db_path, store_path, hugo_posts_dir)
@@ -0,0 +1,394 @@
+"""
+Shared instrumentation for `sitetools.py` and the scripts in `tools/`.
+
+Entry points add the common command line options with :func:`add_arguments`
+and wrap their work in :func:`profile_run`:
+
+    parser = argparse.ArgumentParser()
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        main()
+
+Hot functions are wrapped in named timing spans, either with the
+:func:`timed` decorator or the :func:`span` context manager. Spans are cheap
+(two `perf_counter` calls) and are always recorded; they are only reported
+when one of the profiling options is given.
+
+Work fanned out to worker processes goes through :class:`ProcessPool`
+instead of a bare `ProcessPoolExecutor`: each task returns the spans recorded
+in the worker (and, with `--profile`, the worker's cProfile stats) along with
+its result, and these are merged into the parent's report. Memory tracing
+only covers the parent process.
+
+With `--profile`, the run is profiled with cProfile; the raw stats are dumped
+to a `.prof` file (for use with pstats, snakeviz, etc.) and the top functions
+by cumulative time are summarized. With `--trace-memory`, tracemalloc records
+the peak traced memory and the top allocation sites. Everything is written to
+a single JSON report with the following layout, so runs can be compared:
+
+    {
+        "command": [...],
+        "started": <unix time>,
+        "wall_time_s": <float>,
+        "spans": {<name>: {"count", "total_s", "max_s"}, ...},
+        "profile": {"dump": <path>, "top": [{"function", "ncalls",
+            "tottime_s", "cumtime_s"}, ...]},
+        "memory": {"peak_bytes": <int>, "top": [{"location", "size_bytes",
+            "count"}, ...]}
+    }
+
+"profile" and "memory" are `null` unless the corresponding option is given.
+"""
+import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
+import contextlib
+import cProfile
+import functools
+import json
+import pathlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Iterable, Iterator
+
+
+_spans = {}
+_spans_lock = threading.Lock()
+
+# Whether the current run is being profiled with cProfile (set by
+# `profile_run`), and the cProfile stats returned by worker processes.
+_profiling = False
+_worker_stats = []
+_worker_stats_lock = threading.Lock()
+
+
+def record_span(name: str, elapsed: float):
+    """
+    Add a single timing of `elapsed` seconds to the span `name`.
+    """
+    with _spans_lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+        stats["count"] += 1
+        stats["total_s"] += elapsed
+        stats["max_s"] = max(stats["max_s"], elapsed)
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """
+    Context manager that records the time spent in its body under `name`.
+    """
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start_t)
+
+
+def timed(func=None, *, name: str = None):
+    """
+    Decorator that records each call of the decorated function as a span.
+    The span name defaults to `<module>.<function>`, where `<module>` is the
+    stem of the file defining the function (so it is the same whether the
+    module is imported or run as a script).
+    """
+    if func is None:
+        return functools.partial(timed, name=name)
+
+    module = pathlib.Path(func.__code__.co_filename).stem
+    span_name = name or f"{module}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_t = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_span(span_name, time.perf_counter() - start_t)
+    return wrapper
+
+
+def get_spans() -> dict:
+    with _spans_lock:
+        return {name: dict(stats) for name, stats in _spans.items()}
+
+
+def merge_spans(spans: dict):
+    """
+    Add spans recorded elsewhere (e.g., in a worker process) to this
+    process's spans.
+    """
+    with _spans_lock:
+        for name, other in spans.items():
+            stats = _spans.get(name)
+            if stats is None:
+                _spans[name] = dict(other)
+                continue
+            stats["count"] += other["count"]
+            stats["total_s"] += other["total_s"]
+            stats["max_s"] = max(stats["max_s"], other["max_s"])
+
+
+class _RawStats:
+    """
+    Raw cProfile stats in the form accepted by `pstats.Stats.add`.
+    """
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _run_task(func: Callable, args_list: list, profile: bool):
+    """
+    Run `func` on each tuple of arguments in `args_list` in a worker process.
+
+    Returns:
+        (results, spans, cProfile stats or `None`), where `spans` are those
+        recorded while running this task only.
+    """
+    with _spans_lock:
+        _spans.clear()
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        results = [func(*args) for args in args_list]
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+    stats = None
+    if profiler is not None:
+        profiler.create_stats()
+        stats = profiler.stats
+    return results, get_spans(), stats
+
+
+def _merge_task(future: Future) -> list:
+    results, spans, stats = future.result()
+    merge_spans(spans)
+    if stats is not None:
+        with _worker_stats_lock:
+            _worker_stats.append(stats)
+    return results
+
+
+class ProcessPool:
+    """
+    Process pool whose tasks report their spans (and cProfile stats, when
+    profiling) back to the parent process.
+
+    Use it like `ProcessPoolExecutor`; it can be shared by several stages,
+    since the worker processes are only started once.
+    """
+    def __init__(self, max_workers: int = None):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def submit(self, func: Callable, *args) -> Future:
+        """
+        Run `func(*args)` in a worker; returns a future for its result.
+        """
+        inner = self._executor.submit(_run_task, func, [args], _profiling)
+        outer = Future()
+
+        def done(inner):
+            try:
+                outer.set_result(_merge_task(inner)[0])
+            except BaseException as exc:
+                outer.set_exception(exc)
+
+        inner.add_done_callback(done)
+        return outer
+
+    def map(
+        self, func: Callable, iterable: Iterable, chunksize: int = 16
+    ) -> Iterator:
+        """
+        Like `ProcessPoolExecutor.map`: all tasks are submitted immediately
+        and the results are yielded in order.
+        """
+        items = list(iterable)
+        futures = [
+            self._executor.submit(
+                _run_task, func,
+                [(item,) for item in items[start:start + chunksize]],
+                _profiling,
+            )
+            for start in range(0, len(items), chunksize)
+        ]
+
+        def results():
+            for future in futures:
+                yield from _merge_task(future)
+        return results()
+
+
+@contextlib.contextmanager
+def process_pool(pool: ProcessPool = None, max_workers: int = None):
+    """
+    Context manager yielding `pool` if given (leaving it open) or a new
+    :class:`ProcessPool` that is shut down on exit.
+    """
+    if pool is not None:
+        yield pool
+        return
+    with ProcessPool(max_workers=max_workers) as new_pool:
+        yield new_pool
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the common profiling options to an argument parser.
+    """
+    group = parser.add_argument_group("profiling")
+    group.add_argument(
+        "--profile", action="store_true",
+        help="Profile the run with cProfile and summarize the top functions"
+    )
+    group.add_argument(
+        "--trace-memory", action="store_true",
+        help="Trace memory allocations with tracemalloc and report the peak "
+            "and the top allocation sites"
+    )
+    group.add_argument(
+        "--profile-top", type=int, default=20, metavar="N",
+        help="Number of functions/allocation sites to report (default: 20)"
+    )
+    group.add_argument(
+        "--profile-output", type=pathlib.Path, default=None, metavar="PATH",
+        help="Path to JSON report (default: <script>.profile.json); the "
+            "cProfile dump is written alongside it with a .prof suffix"
+    )
+
+
+def _profile_summary(stats: pstats.Stats, top: int) -> list:
+    rows = []
+    for (fname, lineno, func), (_, ncalls, tottime, cumtime, _) in (
+        stats.stats.items()
+    ):
+        rows.append({
+            "function": f"{fname}:{lineno}({func})",
+            "ncalls": ncalls,
+            "tottime_s": tottime,
+            "cumtime_s": cumtime,
+        })
+    rows.sort(key=lambda row: row["cumtime_s"], reverse=True)
+    return rows[:top]
+
+
+def _memory_summary(snapshot: tracemalloc.Snapshot, top: int) -> list:
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:"
+                f"{stat.traceback[0].lineno}",
+            "size_bytes": stat.size,
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:top]
+    ]
+
+
+@contextlib.contextmanager
+def profile_run(args: argparse.Namespace, name: str = None):
+    """
+    Context manager that profiles its body according to the options added by
+    :func:`add_arguments` and writes the JSON report on exit (including when
+    the body raises).
+
+    Args:
+        args: Parsed command line arguments.
+        name: Name used for the default report path; defaults to the stem of
+            the running script.
+    """
+    global _profiling
+
+    enabled = args.profile or args.trace_memory or args.profile_output
+    if not enabled:
+        yield
+        return
+
+    if name is None:
+        name = pathlib.Path(sys.argv[0]).stem
+    report_fpath = args.profile_output or pathlib.Path(f"{name}.profile.json")
+
+    profiler = cProfile.Profile() if args.profile else None
+    if args.trace_memory:
+        tracemalloc.start()
+
+    started = time.time()
+    start_t = time.perf_counter()
+    if profiler is not None:
+        _profiling = True
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+        wall_time = time.perf_counter() - start_t
+
+        report = {
+            "command": sys.argv,
+            "started": started,
+            "wall_time_s": wall_time,
+            "spans": get_spans(),
+            "profile": None,
+            "memory": None,
+        }
+
+        if profiler is not None:
+            # Combine the parent's stats with those returned by workers.
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            with _worker_stats_lock:
+                for worker_stats in _worker_stats:
+                    stats.add(_RawStats(worker_stats))
+                _worker_stats.clear()
+
+            dump_fpath = report_fpath.with_suffix(".prof")
+            stats.dump_stats(dump_fpath)
+            report["profile"] = {
+                "dump": str(dump_fpath),
+                "top": _profile_summary(stats, args.profile_top),
+            }
+            stats.sort_stats("cumulative").print_stats(args.profile_top)
+
+        if args.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report["memory"] = {
+                "peak_bytes": peak,
+                "top": _memory_summary(snapshot, args.profile_top),
+            }
+            print(
+                f"Peak traced memory: {peak / 2**20:.1f} MiB",
+                file=sys.stderr
+            )
+
+        with open(report_fpath, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote profile report to {report_fpath}", file=sys.stderr)
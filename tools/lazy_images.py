@@ -0,0 +1,265 @@
+"""
+Post-build stage that adds intrinsic dimensions and lazy loading to images.
+
+The dimensions of the images under the source image directories
+(`static/img`, the project GIFs in `content/projects`, etc.) are read once
+from their file headers and stored in a JSON index; on later builds only new
+or modified images are read again. Every `<img>` in the built HTML is then
+rewritten to include:
+
+    - `width`/`height` (if the image is in the index and the tag does not
+      already set them), so the browser reserves space and the layout does not
+      shift as images arrive;
+    - `loading="lazy"` for all but the first few images on each page (those
+      likely to be on the first screen, e.g., the sidebar author image);
+    - `decoding="async"`.
+
+Pages are parsed with :func:`site_pages.rewrite_tags`, so only real `<img>`
+start tags are edited (not, e.g., `<img` inside a script or an attribute).
+
+This stage must run before asset fingerprinting, which renames the images.
+"""
+import argparse
+import functools
+import json
+import pathlib
+import struct
+from typing import Dict, List, Tuple
+
+import instrument
+import site_pages
+
+# Source directories and the URL path at which Hugo publishes their files.
+IMAGE_DIRS = {
+    "static": "/",
+    "content/projects": "/projects/",
+}
+
+
+def image_size(fpath: pathlib.Path) -> Tuple[int, int]:
+    """
+    Read the (width, height) of a PNG, GIF, or JPEG image from its header.
+    Returns `None` for other formats or unreadable files.
+    """
+    with open(fpath, "rb") as f:
+        head = f.read(26)
+
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+
+        if head.startswith(b"\xff\xd8"):
+            # Walk the JPEG segments until a start-of-frame marker.
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                while marker[1] == 0xFF:
+                    marker = marker[1:] + f.read(1)
+                code = marker[1]
+                if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+                    continue
+                length_bytes = f.read(2)
+                if len(length_bytes) < 2:
+                    return None
+                (length,) = struct.unpack(">H", length_bytes)
+                if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, 1)
+    return None
+
+
+@instrument.timed
+def build_index(
+    index_fpath: pathlib.Path = None,
+    image_dirs: Dict[str, str] = IMAGE_DIRS,
+) -> Dict[str, Tuple[int, int]]:
+    """
+    Return a dict mapping the URL path of each source image (e.g.,
+    `/img/rotation_1.png`) to its (width, height).
+
+    Args:
+        index_fpath: Path to the JSON index cache. Entries whose file size
+            and modification time are unchanged are reused; the cache is
+            updated in place. `None` to disable caching.
+        image_dirs: Dict mapping source directories to the URL path at which
+            their contents are published.
+    """
+    cached = {}
+    if index_fpath is not None and index_fpath.exists():
+        with open(index_fpath, "r") as f:
+            cached = json.load(f)
+
+    index = {}
+    entries = {}
+    for src_dir, url_prefix in image_dirs.items():
+        src_dir = pathlib.Path(src_dir)
+        if not src_dir.is_dir():
+            continue
+
+        for fpath in sorted(src_dir.rglob("*")):
+            if fpath.suffix.lower() not in (".png", ".gif", ".jpg", ".jpeg"):
+                continue
+
+            stat = fpath.stat()
+            key = fpath.as_posix()
+            entry = cached.get(key)
+            if (
+                entry is None
+                or entry["mtime"] != stat.st_mtime
+                or entry["size"] != stat.st_size
+            ):
+                size = image_size(fpath)
+                if size is None:
+                    continue
+                entry = {
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "width": size[0],
+                    "height": size[1],
+                }
+            entries[key] = entry
+
+            url_path = url_prefix + fpath.relative_to(src_dir).as_posix()
+            index[url_path] = (entry["width"], entry["height"])
+
+    if index_fpath is not None and entries != cached:
+        with open(index_fpath, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+
+    return index
+
+
+def rewrite_img_tag(
+    tag: str,
+    attrs: List[Tuple[str, str]],
+    base_path: str,
+    index: Dict[str, Tuple[int, int]],
+    lazy: bool,
+) -> str:
+    """
+    Return an `<img>` start tag with the missing width/height, loading, and
+    decoding attributes added.
+
+    Args:
+        tag: Raw start tag text.
+        attrs: The tag's parsed (name, value) attributes.
+    """
+    names = {name for name, _ in attrs}
+    new_attrs = []
+
+    if not names & {"width", "height"}:
+        src = dict(attrs).get("src")
+        if src:
+            size = index.get(site_pages.local_path(src, base_path))
+            if size is not None:
+                new_attrs.append(f'width="{size[0]}" height="{size[1]}"')
+
+    if lazy and "loading" not in names:
+        new_attrs.append('loading="lazy"')
+    if "decoding" not in names:
+        new_attrs.append('decoding="async"')
+
+    if not new_attrs:
+        return tag
+
+    end = -2 if tag.endswith("/>") else -1
+    return f"{tag[:end].rstrip()} {' '.join(new_attrs)}{tag[end:]}"
+
+
+@instrument.timed
+def rewrite_file(
+    fpath: pathlib.Path,
+    build_dir: pathlib.Path,
+    index: Dict[str, Tuple[int, int]],
+    eager: int = 2,
+) -> bool:
+    """
+    Rewrite the `<img>` tags in a single HTML file. The first `eager` images
+    on the page are not lazy-loaded. Returns whether the file was changed.
+    """
+    base_path = site_pages.base_path(fpath, build_dir)
+
+    with open(fpath, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    img_count = 0
+
+    def _rewrite(tag, attrs, raw):
+        nonlocal img_count
+        if tag != "img":
+            return None
+        img_count += 1
+        return rewrite_img_tag(
+            raw, attrs, base_path, index, lazy=img_count > eager
+        )
+
+    updated_text = site_pages.rewrite_tags(text, _rewrite)
+    if updated_text == text:
+        return False
+
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write(updated_text)
+    return True
+
+
+@instrument.timed
+def lazy_images(
+    build_dir: pathlib.Path,
+    index_fpath: pathlib.Path = None,
+    eager: int = 2,
+    max_workers: int = None,
+    pool: instrument.ProcessPool = None,
+):
+    """
+    Add intrinsic dimensions and lazy loading to every image in `build_dir`.
+
+    Args:
+        build_dir: Path to the built site (e.g., `public`).
+        index_fpath: Path to the image dimension index cache (see
+            :func:`build_index`).
+        eager: Number of images at the top of each page to load eagerly.
+        max_workers: Number of processes used to rewrite pages.
+        pool: Process pool to rewrite pages with instead of a new one.
+    """
+    build_dir = pathlib.Path(build_dir)
+    index = build_index(index_fpath)
+
+    rewrite = functools.partial(
+        rewrite_file, build_dir=build_dir, index=index, eager=eager
+    )
+    with instrument.span("lazy_images.rewrite"):
+        rewritten = site_pages.map_pages(
+            rewrite, build_dir, pool=pool, max_workers=max_workers
+        )
+    num_rewritten = sum(changed for _, changed in rewritten)
+
+    print(
+        f"Indexed {len(index)} images; rewrote {num_rewritten}/"
+        f"{len(rewritten)} pages"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "build_dir", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument(
+        "--index", type=pathlib.Path, default=".image-index.json",
+        help="Path to image dimension index cache"
+    )
+    parser.add_argument(
+        "--eager", type=int, default=2,
+        help="Number of images at the top of each page not lazy-loaded"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        lazy_images(args.build_dir, index_fpath=args.index, eager=args.eager)
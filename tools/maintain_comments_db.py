@@ -0,0 +1,423 @@
+"""
+Index and maintain the Isso comments database.
+
+Isso creates its tables without secondary indexes, so after a bulk import
+(see `import_comments.py`) every per-thread fetch (one per `data-isso-id` on
+a page) scans the whole `comments` table. This script:
+
+    - creates the indexes Isso's hot queries need, unless an existing index
+      already covers the same leading columns;
+    - runs `ANALYZE` so the query planner uses them;
+    - returns free pages to the filesystem with an incremental vacuum;
+    - checkpoints and truncates the write-ahead log if the database is in WAL
+      mode.
+
+Isso declares `comments.tid` without a type, so its join condition
+`comments.tid = threads.id` applies numeric affinity to `tid` and SQLite
+cannot use any index on `tid` for it; worse, the planner then skip-scans the
+`tid` index, which is slower than no index at all. The `tid` index is
+therefore only created once `tid` is typed. The one-time `--rebuild` option
+redeclares the column as `tid INTEGER` (the values are unchanged) and switches
+the database to incremental auto-vacuum; both rewrite the database and block
+Isso while they run. Rerun it if an Isso schema migration recreates the
+`comments` table. All other steps are safe to run against the live database.
+
+The query plan and median latency of Isso's queries are measured for the
+threads with the most comments before and after maintenance, and a warning is
+printed for any query that got slower.
+"""
+import argparse
+import pathlib
+import re
+import sqlite3
+import statistics
+import time
+from typing import Dict, List
+
+import instrument
+
+
+# Index name -> (table, columns, where clause of a partial index).
+# `comments_parent` serves Isso's reply lookups (`parent = ?`) and stale
+# comment cleanup. It is partial because a full index on `parent` is chosen by
+# the planner for `parent is null` and `group by parent`, which match most of
+# the table, and makes the per-thread queries slower than without it.
+INDEXES = {
+    "comments_tid_mode_created": (
+        "comments", ("tid", "mode", "created"), None
+    ),
+    "comments_parent": ("comments", ("parent",), "parent is not null"),
+    "threads_uri": ("threads", ("uri",), None),
+}
+
+# Untyped `tid` column declaration in Isso's `comments` table.
+UNTYPED_TID_RE = re.compile(r"\btid\s+REFERENCES\b", re.IGNORECASE)
+
+# A query is reported as slower after maintenance if its median latency grew
+# by more than this factor (allowing for timing noise).
+SLOWDOWN_FACTOR = 1.2
+
+# Isso's per-thread queries (see `isso/db/comments.py` and `threads.py`),
+# with the default mode of 5 (public and pending comments). Each takes the
+# thread URI as its only parameter.
+QUERIES = {
+    "thread": "select * from threads where uri = ?",
+    "fetch": (
+        "select comments.*, likes - dislikes as karma from comments"
+        " inner join threads on threads.uri = ? and comments.tid = threads.id"
+        " and (5 | comments.mode) = 5 and comments.created > 0"
+        " and comments.parent is null"
+        " order by case when comments.parent is not null"
+        " then comments.created end, id"
+    ),
+    "reply_count": (
+        "select comments.parent, count(*) from comments"
+        " inner join threads on threads.uri = ? and comments.tid = threads.id"
+        " and (5 | comments.mode = 5)"
+        " group by comments.parent"
+    ),
+}
+
+
+def existing_indexes(conn: sqlite3.Connection, table: str) -> Dict[str, tuple]:
+    """
+    Return a dict mapping the name of each index on `table` (including the
+    automatic indexes for UNIQUE constraints) to its columns.
+    """
+    return {
+        row[1]: tuple(
+            info[2] for info in conn.execute(f"pragma index_info({row[1]})")
+        )
+        for row in conn.execute(f"pragma index_list({table})")
+    }
+
+
+@instrument.timed
+def ensure_indexes(conn: sqlite3.Connection) -> List[str]:
+    """
+    Create each index in :data:`INDEXES` that is not already covered by an
+    existing index with the same leading columns. While `comments.tid` is
+    untyped (see :func:`retype_tid`), indexes on `tid` are not created, and
+    one created by an earlier run is dropped, since the planner skip-scans
+    them and Isso's per-thread queries get slower.
+
+    Returns:
+        Names of the indexes created.
+    """
+    untyped_tid = UNTYPED_TID_RE.search(comments_sql(conn)) is not None
+    created = []
+    with conn:
+        for name, (table, columns, where) in INDEXES.items():
+            description = f"{table}({', '.join(columns)})"
+            if table == "comments" and columns[0] == "tid" and untyped_tid:
+                dropped = name in existing_indexes(conn, table)
+                conn.execute(f"drop index if exists {name}")
+                print(
+                    f"{description}: "
+                    + (f"dropped {name}" if dropped else "skipped")
+                    + "; comments.tid is untyped, so the index would slow "
+                    "down Isso's queries (run with --rebuild to fix)"
+                )
+                continue
+
+            covering = [
+                index_name
+                for index_name, index_columns
+                in existing_indexes(conn, table).items()
+                if index_columns[:len(columns)] == columns
+            ]
+            if covering:
+                print(f"{description}: covered by {covering[0]}")
+                continue
+
+            conn.execute(
+                f"create index if not exists {name}"
+                f" on {table}({', '.join(columns)})"
+                + (f" where {where}" if where else "")
+            )
+            created.append(name)
+            print(f"{description}: created {name}")
+    return created
+
+
+def comments_sql(conn: sqlite3.Connection) -> str:
+    """
+    Return the `create table` statement of the `comments` table.
+    """
+    return conn.execute(
+        "select sql from sqlite_master where type = 'table'"
+        " and name = 'comments'"
+    ).fetchone()[0]
+
+
+@instrument.timed
+def retype_tid(conn: sqlite3.Connection) -> bool:
+    """
+    Rebuild Isso's `comments` table with `tid` declared as INTEGER so that
+    indexes on `tid` can be used by its joins with `threads`. The triggers
+    and indexes on the table (e.g., Isso's `remove_stale_threads` trigger)
+    are dropped with it and recreated from their original SQL. The rebuild
+    is a single transaction, so a failure leaves the table untouched.
+
+    Returns:
+        Whether the table was rebuilt (`False` if `tid` is already typed).
+    """
+    sql = comments_sql(conn)
+    if not UNTYPED_TID_RE.search(sql):
+        return False
+
+    typed_sql = UNTYPED_TID_RE.sub("tid INTEGER REFERENCES", sql, count=1)
+    dependent_sql = [
+        row[0] for row in conn.execute(
+            "select sql from sqlite_master where tbl_name = 'comments'"
+            " and type in ('index', 'trigger') and sql is not null"
+        )
+    ]
+
+    # The sqlite3 module does not open a transaction before DDL statements,
+    # so manage the transaction explicitly to make the rebuild atomic.
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("begin immediate")
+        try:
+            conn.execute("alter table comments rename to comments_untyped")
+            conn.execute(typed_sql)
+            conn.execute("insert into comments select * from comments_untyped")
+            conn.execute("drop table comments_untyped")
+            for create_sql in dependent_sql:
+                conn.execute(create_sql)
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+
+    print("Rebuilt comments table with tid INTEGER")
+    return True
+
+
+def sample_threads(conn: sqlite3.Connection, num_threads: int) -> List[str]:
+    """
+    Return the URIs of the `num_threads` threads with the most comments.
+    """
+    return [
+        row[0] for row in conn.execute(
+            "select threads.uri from threads"
+            " join comments on comments.tid = threads.id"
+            " group by threads.id order by count(*) desc limit ?",
+            (num_threads,),
+        )
+    ]
+
+
+def query_plans(conn: sqlite3.Connection, uri: str) -> Dict[str, List[str]]:
+    return {
+        name: [
+            row[-1]
+            for row in conn.execute(f"explain query plan {sql}", (uri,))
+        ]
+        for name, sql in QUERIES.items()
+    }
+
+
+def query_latencies(
+    conn: sqlite3.Connection, uris: List[str], repeat: int = 20
+) -> Dict[str, float]:
+    """
+    Return the median latency (in ms) of each query in :data:`QUERIES` over
+    `repeat` runs for each thread in `uris`.
+    """
+    latencies = {}
+    for name, sql in QUERIES.items():
+        times = []
+        for uri in uris:
+            for _ in range(repeat):
+                start_t = time.perf_counter()
+                conn.execute(sql, (uri,)).fetchall()
+                times.append(time.perf_counter() - start_t)
+        latencies[name] = statistics.median(times) * 1000
+    return latencies
+
+
+@instrument.timed
+def vacuum(conn: sqlite3.Connection, pages: int = 0, rebuild: bool = False):
+    """
+    Free up to `pages` pages (0 for all) from the freelist with an incremental
+    vacuum. If `rebuild` is set and the database does not use incremental
+    auto-vacuum, switch it over with a full `VACUUM` instead.
+    """
+    auto_vacuum = conn.execute("pragma auto_vacuum").fetchone()[0]
+    free_before = conn.execute("pragma freelist_count").fetchone()[0]
+
+    if auto_vacuum == 2:
+        # Each step of the pragma frees one page, and `execute` only runs the
+        # first step; `executescript` runs it to completion.
+        conn.executescript(f"pragma incremental_vacuum({int(pages)});")
+    elif rebuild:
+        conn.execute("pragma auto_vacuum = incremental")
+        conn.execute("vacuum")
+    else:
+        print(
+            f"Skipped vacuum: auto_vacuum is not incremental "
+            f"({free_before} free pages); run once with --rebuild to "
+            f"enable it"
+        )
+        return
+
+    free_after = conn.execute("pragma freelist_count").fetchone()[0]
+    print(f"Vacuum: {free_before} -> {free_after} free pages")
+
+
+@instrument.timed
+def checkpoint(conn: sqlite3.Connection):
+    """
+    Checkpoint the write-ahead log and truncate it, if in WAL mode.
+    """
+    journal_mode = conn.execute("pragma journal_mode").fetchone()[0]
+    if journal_mode != "wal":
+        print(f"Skipped WAL checkpoint: journal_mode is {journal_mode}")
+        return
+
+    busy, log_pages, checkpointed = conn.execute(
+        "pragma wal_checkpoint(truncate)"
+    ).fetchone()
+    print(
+        f"WAL checkpoint: {checkpointed}/{log_pages} pages"
+        + (" (busy; retry when the server is idle)" if busy else "")
+    )
+
+
+def print_measurements(label: str, plans: dict, latencies: dict):
+    print(f"{label}:")
+    for name, plan in plans.items():
+        print(f"  {name:<12} {latencies[name]:8.3f} ms  {'; '.join(plan)}")
+
+
+def slower_queries(
+    latencies_before: Dict[str, float], latencies_after: Dict[str, float]
+) -> List[str]:
+    """
+    Return the names of the queries whose median latency grew by more than
+    :data:`SLOWDOWN_FACTOR`.
+    """
+    return [
+        name for name, before in latencies_before.items()
+        if latencies_after[name] > before * SLOWDOWN_FACTOR
+    ]
+
+
+@instrument.timed
+def maintain(
+    db_path: pathlib.Path,
+    num_threads: int = 5,
+    repeat: int = 20,
+    vacuum_pages: int = 0,
+    rebuild: bool = False,
+) -> dict:
+    """
+    Create missing indexes, analyze, vacuum, and checkpoint the database at
+    `db_path`, measuring Isso's queries before and after.
+
+    Args:
+        db_path: Path to the Isso database (e.g., `comments.db`).
+        num_threads: Number of sample threads (those with the most comments)
+            whose queries are measured.
+        repeat: Number of times each query is run per sample thread.
+        vacuum_pages: Maximum number of pages freed by the incremental vacuum
+            (0 for all).
+        rebuild: Redeclare `comments.tid` as INTEGER (see :func:`retype_tid`)
+            and switch to incremental auto-vacuum (see :func:`vacuum`). Both
+            rewrite the database and block the server while they run.
+    Returns:
+        Dict with whether `tid` was retyped, the created indexes, the names
+        of the queries that got slower (see :func:`slower_queries`), and the
+        query plans and latencies before and after.
+    """
+    # Wait for the server's write locks rather than failing immediately.
+    conn = sqlite3.connect(db_path, timeout=30)
+
+    uris = sample_threads(conn, num_threads)
+    if not uris:
+        print("No comments; skipping query measurements")
+
+    def measure():
+        if not uris:
+            return {}, {}
+        return (
+            query_plans(conn, uris[0]),
+            query_latencies(conn, uris, repeat=repeat),
+        )
+
+    plans_before, latencies_before = measure()
+
+    retyped = False
+    if rebuild:
+        retyped = retype_tid(conn)
+    created = ensure_indexes(conn)
+    with instrument.span("maintain_comments_db.analyze"):
+        conn.execute("analyze")
+        conn.commit()
+    vacuum(conn, pages=vacuum_pages, rebuild=rebuild)
+    checkpoint(conn)
+
+    plans_after, latencies_after = measure()
+    conn.close()
+
+    slower = slower_queries(latencies_before, latencies_after)
+    if uris:
+        print(f"Sample threads: {', '.join(uris)}")
+        print_measurements("Before", plans_before, latencies_before)
+        print_measurements("After", plans_after, latencies_after)
+    for name in slower:
+        print(
+            f"Warning: {name} is slower after maintenance "
+            f"({latencies_before[name]:.3f} -> {latencies_after[name]:.3f} "
+            "ms)"
+        )
+
+    return {
+        "retyped_tid": retyped,
+        "created": created,
+        "slower": slower,
+        "before": {"plans": plans_before, "latencies_ms": latencies_before},
+        "after": {"plans": plans_after, "latencies_ms": latencies_after},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db", type=pathlib.Path, default="comments.db",
+        help="Path to Isso comments database"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=5,
+        help="Number of sample threads (with the most comments) to measure"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20,
+        help="Number of runs of each query per sample thread"
+    )
+    parser.add_argument(
+        "--vacuum-pages", type=int, default=0,
+        help="Maximum pages freed by the incremental vacuum (0 for all)"
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="Redeclare comments.tid as INTEGER so its index is used, and "
+            "switch to incremental auto-vacuum (one-time; rewrites the "
+            "database and blocks the server while it runs)"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        maintain(
+            args.db,
+            num_threads=args.threads,
+            repeat=args.repeat,
+            vacuum_pages=args.vacuum_pages,
+            rebuild=args.rebuild,
+        )
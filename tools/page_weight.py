@@ -0,0 +1,315 @@
+"""
+Per-page weight report and budget enforcement for a built site.
+
+For each HTML page in the build directory, the resources the page loads are
+followed: stylesheets (and, for local stylesheets, the fonts, images, and
+`@import`s they reference), scripts, images, icons, and embedded frames. Local
+resources are sized from the files in the build directory; third-party
+resources (e.g., YouTube embeds) are counted as requests, since their size is
+not known at build time.
+
+The heaviest pages are printed, a JSON report is written, and pages exceeding
+the configured byte or request budgets are reported as failures.
+"""
+import argparse
+import json
+import pathlib
+import re
+import sys
+from typing import List
+import urllib.parse
+
+import bs4
+
+import instrument
+import site_pages
+
+
+CATEGORIES = {
+    "css": (".css",),
+    "js": (".js",),
+    "image": (
+        ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico", ".avif"
+    ),
+    "font": (".woff", ".woff2", ".ttf", ".otf", ".eot"),
+}
+
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+CSS_IMPORT_RE = re.compile(r"""@import\s+['"]([^'"]+)['"]""")
+
+
+def category(url_path: str) -> str:
+    suffix = pathlib.PurePosixPath(url_path).suffix.lower()
+    for name, suffixes in CATEGORIES.items():
+        if suffix in suffixes:
+            return name
+    return "other"
+
+
+@instrument.timed
+def page_resources(fpath: pathlib.Path) -> List[str]:
+    """
+    Return the URLs of the resources loaded by an HTML page (as written in
+    the page; relative URLs are not resolved).
+    """
+    with open(fpath, "r", encoding="utf-8") as f:
+        soup = bs4.BeautifulSoup(f, "html.parser")
+
+    urls = []
+    for tag in soup.find_all("link", href=True):
+        rel = {r.lower() for r in tag.get("rel", [])}
+        if rel & {"stylesheet", "icon", "shortcut", "apple-touch-icon",
+                "manifest", "preload"}:
+            urls.append(tag["href"])
+    for tag in soup.find_all(["script", "img", "iframe", "source", "video"]):
+        if tag.get("src"):
+            urls.append(tag["src"])
+    return [url.strip() for url in urls]
+
+
+class Resolver:
+    """
+    Resolves resource URLs to files in the build directory and follows the
+    references in local stylesheets. Sizes and stylesheet references are
+    memoized, since most resources are shared by many pages.
+    """
+    def __init__(self, build_dir: pathlib.Path):
+        self.build_dir = build_dir
+        self.sizes = {}
+        self.css_refs = {}
+
+    def size(self, url_path: str) -> int:
+        """
+        Size in bytes of the file serving `url_path`; `None` if missing.
+        """
+        if url_path not in self.sizes:
+            fpath = self.build_dir / url_path.lstrip("/")
+            if fpath.is_dir():
+                fpath = fpath / "index.html"
+            self.sizes[url_path] = (
+                fpath.stat().st_size if fpath.is_file() else None
+            )
+        return self.sizes[url_path]
+
+    def stylesheet_refs(self, url_path: str) -> List[str]:
+        """
+        URLs referenced by a local stylesheet via `url()` or `@import`.
+        """
+        if url_path not in self.css_refs:
+            fpath = self.build_dir / url_path.lstrip("/")
+            refs = []
+            if fpath.is_file():
+                text = fpath.read_text(encoding="utf-8", errors="replace")
+                refs = CSS_IMPORT_RE.findall(text) + CSS_URL_RE.findall(text)
+            self.css_refs[url_path] = refs
+        return self.css_refs[url_path]
+
+    def page_weight(self, fpath: pathlib.Path, urls: List[str]) -> dict:
+        rel_path = fpath.relative_to(self.build_dir).as_posix()
+        base_path = site_pages.base_path(fpath, self.build_dir)
+
+        weight = {
+            "page": rel_path,
+            "html_bytes": fpath.stat().st_size,
+            "css_bytes": 0,
+            "js_bytes": 0,
+            "image_bytes": 0,
+            "font_bytes": 0,
+            "other_bytes": 0,
+            "requests": 1,
+            "third_party_requests": 0,
+            "third_party_hosts": [],
+            "missing": [],
+        }
+
+        seen = set()
+        queue = [(url, base_path) for url in urls]
+        third_party_hosts = set()
+
+        while queue:
+            url, base = queue.pop()
+            target = site_pages.classify_url(url, base)
+            if target is None or target in seen:
+                continue
+            seen.add(target)
+
+            kind, value = target
+            weight["requests"] += 1
+
+            if kind == "external":
+                weight["third_party_requests"] += 1
+                third_party_hosts.add(urllib.parse.urlsplit(value).hostname)
+                continue
+
+            size = self.size(value)
+            if size is None:
+                weight["missing"].append(value)
+                continue
+
+            resource_category = category(value)
+            weight[f"{resource_category}_bytes"] += size
+
+            if resource_category == "css":
+                css_base = value.rsplit("/", 1)[0] + "/"
+                queue.extend(
+                    (ref, css_base) for ref in self.stylesheet_refs(value)
+                )
+
+        weight["third_party_hosts"] = sorted(third_party_hosts)
+        weight["total_bytes"] = sum(
+            weight[f"{name}_bytes"]
+            for name in ("html", "css", "js", "image", "font", "other")
+        )
+        return weight
+
+
+@instrument.timed
+def page_weights(
+    build_dir: pathlib.Path,
+    max_workers: int = None,
+    pool: instrument.ProcessPool = None,
+) -> List[dict]:
+    """
+    Return the weight of every HTML page in `build_dir`, heaviest first.
+    """
+    build_dir = pathlib.Path(build_dir)
+    resolver = Resolver(build_dir)
+    weights = [
+        resolver.page_weight(fpath, urls)
+        for fpath, urls in site_pages.map_pages(
+            page_resources, build_dir, pool=pool, max_workers=max_workers
+        )
+    ]
+    weights.sort(key=lambda weight: weight["total_bytes"], reverse=True)
+    return weights
+
+
+def check_budgets(
+    weights: List[dict],
+    max_bytes: int = None,
+    max_requests: int = None,
+    max_third_party: int = None,
+) -> List[str]:
+    """
+    Return a description of each budget exceeded by a page (empty if all
+    pages are within budget). A budget of `None` is not enforced.
+    """
+    budgets = [
+        ("total_bytes", max_bytes, "bytes"),
+        ("requests", max_requests, "requests"),
+        ("third_party_requests", max_third_party, "third-party requests"),
+    ]
+    violations = []
+    for weight in weights:
+        for key, budget, label in budgets:
+            if budget is not None and weight[key] > budget:
+                violations.append(
+                    f"{weight['page']}: {weight[key]} {label} "
+                    f"(budget {budget})"
+                )
+    return violations
+
+
+def print_report(weights: List[dict], top: int = 10):
+    print(f"Heaviest {min(top, len(weights))} of {len(weights)} pages:")
+    for weight in weights[:top]:
+        print(
+            f"  {weight['total_bytes'] / 1024:>9.1f} KiB "
+            f"{weight['requests']:>4} req "
+            f"({weight['third_party_requests']} third-party)  "
+            f"{weight['page']}"
+        )
+
+
+@instrument.timed
+def weight_report(
+    build_dir: pathlib.Path,
+    report_fpath: pathlib.Path = None,
+    max_bytes: int = None,
+    max_requests: int = None,
+    max_third_party: int = None,
+    top: int = 10,
+    pool: instrument.ProcessPool = None,
+) -> List[str]:
+    """
+    Compute page weights, print the heaviest pages, write the JSON report,
+    and check the budgets.
+
+    Returns:
+        List of budget violations (see :func:`check_budgets`).
+    """
+    weights = page_weights(build_dir, pool=pool)
+    print_report(weights, top=top)
+
+    violations = check_budgets(
+        weights, max_bytes=max_bytes, max_requests=max_requests,
+        max_third_party=max_third_party,
+    )
+
+    if report_fpath is not None:
+        with open(report_fpath, "w") as f:
+            json.dump(
+                {
+                    "budgets": {
+                        "max_bytes": max_bytes,
+                        "max_requests": max_requests,
+                        "max_third_party": max_third_party,
+                    },
+                    "violations": violations,
+                    "pages": weights,
+                },
+                f, indent=2,
+            )
+
+    return violations
+
+
+def add_budget_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the page weight budget options to an argument parser.
+    """
+    parser.add_argument(
+        "--budget-bytes", type=int, default=None,
+        help="Fail if any page (with its resources) exceeds this many bytes"
+    )
+    parser.add_argument(
+        "--budget-requests", type=int, default=None,
+        help="Fail if any page makes more than this many requests"
+    )
+    parser.add_argument(
+        "--budget-third-party", type=int, default=None,
+        help="Fail if any page makes more than this many third-party "
+            "requests"
+    )
+    parser.add_argument(
+        "--weight-report", type=pathlib.Path, default="page-weight.json",
+        help="Path to output JSON page weight report"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "build_dir", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of heaviest pages to list"
+    )
+    add_budget_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        violations = weight_report(
+            args.build_dir,
+            report_fpath=args.weight_report,
+            max_bytes=args.budget_bytes,
+            max_requests=args.budget_requests,
+            max_third_party=args.budget_third_party,
+            top=args.top,
+        )
+
+    for violation in violations:
+        print(f"Over budget: {violation}")
+    sys.exit(1 if violations else 0)
@@ -1,12 +1,22 @@
 import argparse
 import pathlib
 import re
+from typing import List
 
+import instrument
 
-def renumber_links(fpath: pathlib.Path):
-    with open(fpath, "r") as f:
-        lines = f.readlines()
 
+@instrument.timed
+def renumber_lines(lines: List[str]) -> List[str]:
+    """
+    Renumber the reference-style links in a post so that they are numbered
+    in order of first appearance and each link appears in the reflist once.
+
+    Args:
+        lines: Lines of the post (with newlines), ending in the reflist.
+    Returns:
+        The updated lines.
+    """
     old_refs = {}
     reflist_expr = r"\[(\d+)\]: (.+)$"
 
@@ -63,6 +73,15 @@ def renumber_links(fpath: pathlib.Path):
         line = f"[{refnum}]: {link}\n"
         updated_lines.append(line)
 
+    return updated_lines
+
+
+def renumber_links(fpath: pathlib.Path):
+    with open(fpath, "r") as f:
+        lines = f.readlines()
+
+    updated_lines = renumber_lines(lines)
+
     with open(fpath, "w") as f:
         f.writelines(updated_lines)
 
@@ -70,5 +89,8 @@ def renumber_links(fpath: pathlib.Path):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path", type=pathlib.Path)
+    instrument.add_arguments(parser)
     args = parser.parse_args()
-    renumber_links(args.path)
+
+    with instrument.profile_run(args):
+        renumber_links(args.path)
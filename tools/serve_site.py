@@ -0,0 +1,408 @@
+"""
+Local preview server for the built site.
+
+Serves the exact contents of the build directory (e.g., `public/` after
+`sitetools.py build` and its post-build stages) so the deployed artifacts can
+be checked and load-tested locally:
+
+    - files are held in an in-memory LRU cache (bounded by total bytes) and
+      revalidated against their modification time on each request;
+    - responses carry an `ETag` and `Last-Modified`, and conditional requests
+      (`If-None-Match`, `If-Modified-Since`) get `304 Not Modified`;
+    - single byte-range requests get `206 Partial Content`;
+    - precompressed `.br`/`.gz` sidecar files are served in place of the
+      original when the client accepts that encoding;
+    - requests are handled concurrently by a fixed-size thread pool.
+
+Each request is logged with its latency, and a latency summary is printed
+when the server stops.
+"""
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import email.utils
+import http
+import http.server
+import mimetypes
+import pathlib
+import statistics
+import threading
+import time
+import urllib.parse
+
+import instrument
+
+
+# Sidecar suffix for each content encoding, in order of preference.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class FileCache:
+    """
+    Thread-safe LRU cache of file contents, bounded by the total number of
+    bytes cached. Entries are keyed by path and invalidated when the file's
+    modification time or size changes.
+    """
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fpath: pathlib.Path):
+        """
+        Return (data, stat) for `fpath`, reading the file on a cache miss.
+        """
+        stat = fpath.stat()
+        with self.lock:
+            entry = self.entries.get(fpath)
+            if entry is not None:
+                data, cached_stat = entry
+                if (
+                    cached_stat.st_mtime_ns == stat.st_mtime_ns
+                    and cached_stat.st_size == stat.st_size
+                ):
+                    self.entries.move_to_end(fpath)
+                    self.hits += 1
+                    return data, cached_stat
+            self.misses += 1
+
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        if len(data) <= self.max_bytes:
+            with self.lock:
+                old = self.entries.pop(fpath, None)
+                if old is not None:
+                    self.num_bytes -= len(old[0])
+                self.entries[fpath] = (data, stat)
+                self.num_bytes += len(data)
+                while self.num_bytes > self.max_bytes:
+                    _, (evicted, _) = self.entries.popitem(last=False)
+                    self.num_bytes -= len(evicted)
+        return data, stat
+
+
+def accepted_encodings(header: str) -> set:
+    """
+    Parse an `Accept-Encoding` header into the set of acceptable encodings.
+    """
+    encodings = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                pass
+        if name and q > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def parse_range(header: str, size: int):
+    """
+    Parse a single `bytes=` range against a representation of `size` bytes.
+
+    Returns:
+        (start, end) inclusive byte offsets; `None` if the header is absent,
+        malformed, or has multiple ranges (serve the whole file); or
+        `(None, None)` if the range is unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            start = int(start)
+            end = int(end) if end else size - 1
+        elif end:
+            # Suffix range: the last `end` bytes.
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        return (None, None)
+    return start, min(end, size - 1)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "nrsyed-preview"
+
+    # Close idle keep-alive connections so they do not tie up pool workers.
+    timeout = 5
+
+    def do_GET(self):
+        self._timed(head_only=False)
+
+    def do_HEAD(self):
+        self._timed(head_only=True)
+
+    def _timed(self, head_only: bool):
+        start_t = time.perf_counter()
+        self._status = None
+        self._num_bytes = 0
+        try:
+            self._serve(head_only)
+        finally:
+            elapsed = time.perf_counter() - start_t
+            self.server.record_latency(elapsed)
+            if not self.server.quiet:
+                print(
+                    f"{self.command} {self.path} {self._status} "
+                    f"{self._num_bytes}B {elapsed * 1000:.2f} ms"
+                )
+
+    def log_message(self, format, *args):
+        # Requests are logged with their latency in `_timed`.
+        pass
+
+    def _send(self, status, headers=None, body=b"", head_only=False):
+        self._status = int(status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head_only and body:
+            self.wfile.write(body)
+            self._num_bytes = len(body)
+
+    def _resolve(self, url_path: str) -> pathlib.Path:
+        root = self.server.root
+        fpath = (root / url_path.lstrip("/")).resolve()
+        if fpath != root and root not in fpath.parents:
+            return None
+        if fpath.is_dir():
+            fpath = fpath / "index.html"
+        return fpath if fpath.is_file() else None
+
+    def _serve(self, head_only: bool):
+        url_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        fpath = self._resolve(url_path)
+
+        if fpath is None:
+            self._send(
+                http.HTTPStatus.NOT_FOUND, body=b"Not Found",
+                headers={"Content-Type": "text/plain"}, head_only=head_only
+            )
+            return
+
+        if fpath.name == "index.html" and not url_path.endswith(("/", ".html")):
+            self._send(
+                http.HTTPStatus.MOVED_PERMANENTLY,
+                headers={"Location": url_path + "/"}, head_only=head_only
+            )
+            return
+
+        if fpath.suffix == ".php":
+            # PHP is executed by Apache in production; never serve its source.
+            self._send(
+                http.HTTPStatus.NOT_IMPLEMENTED, body=b"PHP not supported",
+                headers={"Content-Type": "text/plain"}, head_only=head_only
+            )
+            return
+
+        content_type = (
+            mimetypes.guess_type(fpath.name)[0] or "application/octet-stream"
+        )
+        if content_type.startswith("text/") or content_type.endswith(
+            ("javascript", "json")
+        ):
+            content_type += "; charset=utf-8"
+
+        # Prefer a precompressed sidecar the client accepts.
+        encoding = None
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding"))
+        for name, suffix in ENCODINGS:
+            sidecar = fpath.with_name(fpath.name + suffix)
+            if name in accepted and sidecar.is_file():
+                fpath, encoding = sidecar, name
+                break
+
+        data, stat = self.server.cache.get(fpath)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        headers = {
+            "Content-Type": content_type,
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Accept-Ranges": "bytes",
+            "Vary": "Accept-Encoding",
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        if self._not_modified(etag, stat.st_mtime):
+            self._status = int(http.HTTPStatus.NOT_MODIFIED)
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            for key in ("ETag", "Last-Modified", "Vary"):
+                self.send_header(key, headers[key])
+            self.end_headers()
+            return
+
+        byte_range = parse_range(self.headers.get("Range"), len(data))
+        if byte_range is None:
+            self._send(http.HTTPStatus.OK, headers, data, head_only)
+        elif byte_range == (None, None):
+            self._send(
+                http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                {"Content-Range": f"bytes */{len(data)}"},
+                head_only=head_only,
+            )
+        else:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            self._send(
+                http.HTTPStatus.PARTIAL_CONTENT, headers,
+                data[start:end + 1], head_only
+            )
+
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+
+class PreviewServer(http.server.HTTPServer):
+    """
+    HTTP server that hands each connection to a fixed-size thread pool and
+    keeps per-request latency statistics.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self, address, root: pathlib.Path, cache_bytes: int = 64 * 2**20,
+        workers: int = 16, quiet: bool = False,
+    ):
+        super().__init__(address, RequestHandler)
+        self.root = pathlib.Path(root).resolve()
+        self.cache = FileCache(cache_bytes)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.quiet = quiet
+        self.latencies = []
+        self.latency_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def record_latency(self, elapsed: float):
+        with self.latency_lock:
+            self.latencies.append(elapsed)
+
+    def latency_summary(self) -> dict:
+        with self.latency_lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {"requests": 0}
+
+        def percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+        return {
+            "requests": len(latencies),
+            "mean_ms": statistics.fmean(latencies) * 1000,
+            "p50_ms": percentile(0.50) * 1000,
+            "p95_ms": percentile(0.95) * 1000,
+            "p99_ms": percentile(0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+        }
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(
+    root: pathlib.Path = pathlib.Path("public"),
+    host: str = "127.0.0.1",
+    port: int = 1313,
+    cache_bytes: int = 64 * 2**20,
+    workers: int = 16,
+    quiet: bool = False,
+):
+    """
+    Serve `root` until interrupted, then print a latency summary.
+    """
+    server = PreviewServer(
+        (host, port), root, cache_bytes=cache_bytes, workers=workers,
+        quiet=quiet,
+    )
+    print(f"Serving {server.root} at http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        summary = server.latency_summary()
+        print(
+            ", ".join(
+                f"{key}={value:.2f}" if isinstance(value, float)
+                else f"{key}={value}"
+                for key, value in summary.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "root", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=1313)
+    parser.add_argument(
+        "--cache-mb", type=float, default=64,
+        help="Maximum size of the in-memory file cache (MiB)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=16, help="Number of worker threads"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Do not log each request"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        serve(
+            args.root, host=args.host, port=args.port,
+            cache_bytes=int(args.cache_mb * 2**20), workers=args.workers,
+            quiet=args.quiet,
+        )
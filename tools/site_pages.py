@@ -0,0 +1,188 @@
+"""
+Shared helpers for the stages that read a built site (`public/`): locating
+its HTML pages, mapping a function over them in a process pool, and resolving
+the URLs found in them to local paths or external URLs.
+
+All stages resolve URLs the same way: a URL is local if it has no host or
+its host is one of :data:`SITE_HOSTS`; local URLs are resolved against the
+directory of the page (or stylesheet) containing them and percent-decoded,
+giving the URL path of a file in the build directory, e.g., `img/a.png` on
+`/2018/05/06/post/` -> `/2018/05/06/post/img/a.png`.
+
+Stages that edit pages do so with :func:`rewrite_tags`, which replaces only
+the start tags (and `<style>` blocks) they change and leaves the rest of the
+page byte-for-byte unchanged.
+"""
+import html.parser
+import pathlib
+from typing import Callable, List, Tuple
+import urllib.parse
+
+import instrument
+
+
+SITE_HOSTS = ("nrsyed.com", "www.nrsyed.com")
+
+
+def html_pages(build_dir: pathlib.Path) -> List[pathlib.Path]:
+    return sorted(pathlib.Path(build_dir).rglob("*.html"))
+
+
+def base_path(fpath: pathlib.Path, build_dir: pathlib.Path) -> str:
+    """
+    Return the URL path of the directory containing a built file, against
+    which relative URLs in the file are resolved, e.g.,
+    `public/2018/05/06/post/index.html` -> `/2018/05/06/post/`.
+    """
+    rel_dir = fpath.parent.relative_to(build_dir).as_posix()
+    return "/" if rel_dir == "." else f"/{rel_dir}/"
+
+
+def page_url_path(fpath: pathlib.Path, build_dir: pathlib.Path) -> str:
+    """
+    Return the URL path at which a built file is served, e.g.,
+    `public/2018/05/06/post/index.html` -> `/2018/05/06/post/`.
+    """
+    rel_path = fpath.relative_to(build_dir).as_posix()
+    if rel_path == "index.html":
+        return "/"
+    if rel_path.endswith("/index.html"):
+        return "/" + rel_path[:-len("index.html")]
+    return "/" + rel_path
+
+
+def external_url(url: str) -> str:
+    """
+    Normalize an external URL: drop the fragment and give protocol-relative
+    URLs (`//host/...`) an explicit scheme.
+    """
+    url = urllib.parse.urldefrag(url)[0]
+    if url.startswith("//"):
+        url = "https:" + url
+    return url
+
+
+def classify_url(url: str, base: str) -> Tuple[str, str]:
+    """
+    Classify a URL found in a page or stylesheet whose directory's URL path
+    is `base` (see :func:`base_path`).
+
+    Returns:
+        ("local", url_path) for URLs on this site, ("external", url) for
+        http(s) URLs on other hosts (normalized with :func:`external_url`), or
+        `None` for URLs that are not fetched over HTTP (e.g., `mailto:`,
+        `data:`).
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    if parts.scheme and parts.scheme not in ("http", "https"):
+        return None
+    if parts.netloc and parts.hostname not in SITE_HOSTS:
+        return ("external", external_url(url.strip()))
+    return (
+        "local",
+        urllib.parse.urljoin(base, urllib.parse.unquote(parts.path)),
+    )
+
+
+def local_path(url: str, base: str) -> str:
+    """
+    Return the local URL path a URL refers to, or `None` if it is not on this
+    site (see :func:`classify_url`).
+    """
+    target = classify_url(url, base)
+    if target is None or target[0] != "local":
+        return None
+    return target[1]
+
+
+class _TagSplicer(html.parser.HTMLParser):
+    """
+    Collects the replacements of the start tags and `<style>` blocks of an
+    HTML document as (start, end, new text) offsets into the document.
+    """
+    def __init__(
+        self, text: str, rewrite_tag: Callable, rewrite_style: Callable
+    ):
+        super().__init__(convert_charrefs=False)
+        self.rewrite_tag = rewrite_tag
+        self.rewrite_style = rewrite_style
+        self.edits: List[Tuple[int, int, str]] = []
+
+        # `getpos()` counts lines by "\n" only, so the line offsets must too
+        # (`str.splitlines` also splits on, e.g., "\x0c" and U+2028).
+        self.line_offsets = [0]
+        for line in text.split("\n"):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+
+    def _offset(self) -> int:
+        lineno, col = self.getpos()
+        return self.line_offsets[lineno - 1] + col
+
+    def _replace(self, old: str, new: str):
+        if new is not None and new != old:
+            start = self._offset()
+            self.edits.append((start, start + len(old), new))
+
+    def handle_starttag(self, tag, attrs):
+        raw = self.get_starttag_text()
+        self._replace(raw, self.rewrite_tag(tag, attrs, raw))
+
+    handle_startendtag = handle_starttag
+
+    def handle_data(self, data):
+        if self.rewrite_style is not None and self.cdata_elem == "style":
+            self._replace(data, self.rewrite_style(data))
+
+
+def rewrite_tags(
+    text: str, rewrite_tag: Callable, rewrite_style: Callable = None
+) -> str:
+    """
+    Rewrite the start tags of an HTML document, leaving everything else
+    (text, comments, scripts, etc.) unchanged.
+
+    Args:
+        text: HTML document.
+        rewrite_tag: Function of (tag name, list of parsed (name, value)
+            attributes, raw start tag text) returning the new start tag text,
+            or `None` to leave the tag unchanged.
+        rewrite_style: Optional function of the contents of a `<style>` block
+            returning its new contents.
+    Returns:
+        The rewritten document.
+    """
+    splicer = _TagSplicer(text, rewrite_tag, rewrite_style)
+    splicer.feed(text)
+    splicer.close()
+
+    parts = []
+    end = 0
+    for start, stop, new in splicer.edits:
+        parts.append(text[end:start])
+        parts.append(new)
+        end = stop
+    parts.append(text[end:])
+    return "".join(parts)
+
+
+def map_pages(
+    func: Callable,
+    build_dir: pathlib.Path,
+    pool: instrument.ProcessPool = None,
+    max_workers: int = None,
+) -> List[Tuple[pathlib.Path, object]]:
+    """
+    Call `func(fpath)` on every HTML page in `build_dir` in a process pool.
+
+    Args:
+        func: Picklable function of a page path (e.g., a module-level
+            function or a `functools.partial` of one).
+        build_dir: Path to the built site.
+        pool: Pool to use (e.g., one shared by all post-build stages); a new
+            pool with `max_workers` processes is used if `None`.
+    Returns:
+        List of (page path, result) tuples, in sorted page order.
+    """
+    fpaths = html_pages(build_dir)
+    with instrument.process_pool(pool, max_workers=max_workers) as pool:
+        return list(zip(fpaths, pool.map(func, fpaths, chunksize=16)))
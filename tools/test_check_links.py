@@ -0,0 +1,135 @@
+"""
+Tests for `check_links.py`, run against a small built site in a temporary
+directory. External links are redirected with `host_overrides` (as with
+`--host-override`) to a local stand-in server.
+
+Run with `python -m pytest tools` or `python -m unittest` from `tools/`.
+"""
+import http.server
+import pathlib
+import tempfile
+import threading
+import unittest
+
+import check_links
+
+
+PAGES = {
+    "index.html": """\
+<html><body id="top">
+<a href="#top">Top</a>
+<a href="#gone">Missing same-page anchor</a>
+<a href="/post/">Post</a>
+<a href="/post">Post without trailing slash</a>
+<a href="post/#intro">Post intro</a>
+<a href="/post/#nope">Missing anchor on another page</a>
+<a href="https://nrsyed.com/post/">Absolute link to this site</a>
+<a href="/missing/">Missing page</a>
+<a href='REF_NOT_FOUND: Ref "gone.md": "content/index.md:1:1"'>Ref</a>
+<a href="mailto:someone@example.com">Email</a>
+<img src="/img/ok.png">
+<img src="/img/missing.png">
+<a href="https://example.com/ok">External</a>
+<a href="https://example.com/dead#section">Dead external</a>
+</body></html>
+""",
+    "post/index.html": """\
+<html><body>
+<h2 id="intro">Intro</h2>
+<a name="legacy"></a>
+<a href="../#top">Home</a>
+<a href="#legacy">Named anchor</a>
+<img src="../img/ok.png">
+</body></html>
+""",
+}
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers 200 for `/ok` and 404 for every other path.
+    """
+    def _respond(self):
+        self.send_response(200 if self.path == "/ok" else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = _respond
+    do_HEAD = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CheckSiteTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), StandInHandler
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = pathlib.Path(tmp_dir.name)
+
+        self.build_dir = self.tmp_dir / "public"
+        for rel_path, text in PAGES.items():
+            fpath = self.build_dir / rel_path
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            fpath.write_text(text)
+        (self.build_dir / "img").mkdir()
+        (self.build_dir / "img" / "ok.png").write_bytes(b"")
+
+    def check_site(self, **kwargs):
+        errors = check_links.check_site(
+            self.build_dir, max_workers=2,
+            host_overrides={"*": self.base_url}, timeout=5, **kwargs
+        )
+        return {
+            (pathlib.Path(fpath).relative_to(self.build_dir).as_posix(), url,
+                error)
+            for fpath, url, error in errors
+        }
+
+    def test_internal(self):
+        self.assertEqual(
+            self.check_site(external=False),
+            {
+                ("index.html", "#gone", "missing anchor"),
+                ("index.html", "/post/#nope", "missing anchor"),
+                ("index.html", "/missing/", "not found"),
+                ("index.html", "/img/missing.png", "not found"),
+                (
+                    "index.html",
+                    'REF_NOT_FOUND: Ref "gone.md": "content/index.md:1:1"',
+                    "unresolved ref shortcode",
+                ),
+            },
+        )
+
+    def test_external_with_host_override(self):
+        cache_fpath = self.tmp_dir / "linkcache.json"
+        errors = self.check_site(cache_fpath=cache_fpath)
+
+        self.assertIn(
+            ("index.html", "https://example.com/dead#section", "HTTP 404"),
+            errors,
+        )
+        self.assertEqual(
+            {url for _, url, _ in errors if url.startswith("https://")},
+            {"https://example.com/dead#section"},
+        )
+        # Results from a stand-in server are not cached.
+        self.assertFalse(cache_fpath.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+"""
+Self-hosts the site's third-party assets: KaTeX and the Abril Fatface web
+font, which would otherwise be loaded from cdn.jsdelivr.net and Google Fonts
+(an extra DNS lookup, TLS connection, and render-blocking stylesheet per
+host).
+
+`fetch` downloads the assets once into `static/vendor/` (not committed), so
+Hugo publishes them at `/vendor/` in every build, including `hugo server`.
+Since the templates link them there instead of the CDNs, a build fails if any
+are missing (see :func:`missing_assets`).
+The KaTeX files are verified against the same SRI hashes the templates used
+with the CDN. Only the woff2 KaTeX fonts are kept, since every browser that
+runs KaTeX supports them. Abril Fatface is converted to woff2 and written with
+an `@font-face` stylesheet.
+
+After a build, :func:`subset_web_font` subsets the published copy of Abril
+Fatface to the glyphs actually rendered in it (the site title). It and the
+KaTeX files are then fingerprinted by the `fingerprint_assets` stage.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import pathlib
+import re
+import urllib.request
+
+import bs4
+from fontTools import subset
+from fontTools.ttLib import TTFont
+
+import instrument
+import site_pages
+
+
+KATEX_URL = "https://cdn.jsdelivr.net/npm/katex@0.12.0/dist/"
+
+# SRI hashes of the KaTeX files (as previously used in
+# `layouts/partials/katex.html`).
+KATEX_FILES = {
+    "katex.min.css": (
+        "sha384-"
+        "AfEj0r4/OFrOo5t7NnNe46zW/tFgW6x/bCJG8FqQCEo3+Aro6EYUG4+cU+KJWu/X"
+    ),
+    "katex.min.js": (
+        "sha384-"
+        "g7c+Jr9ZivxKLnZTDUhnkOnsh30B4H0rpLUpJ4jAIKs4fnJI+sEnkvrMWph2EDg4"
+    ),
+    "contrib/auto-render.min.js": (
+        "sha384-"
+        "mll67QQFJfxn0IYznZYonOWZ644AWYC+Pt2cHqMaRhXVrursRwvLnLaebdGIlYNa"
+    ),
+}
+
+FONT_CSS_URL = "https://fonts.googleapis.com/css2?family=Abril+Fatface"
+FONT_FAMILY = "Abril Fatface"
+
+# Elements rendered in the font (see `assets/scss/hyde-hyde/_sidebar.scss`).
+FONT_SELECTOR = ".site__title"
+
+# Paths of the vendored assets relative to `static/` (and so to the build
+# directory).
+KATEX_DIR = "vendor/katex"
+FONT_DIR = "vendor/fonts"
+FONT_SUBSET_FNAME = "abril-fatface.woff2"
+FONT_CSS_FNAME = "abril-fatface.css"
+
+FONT_FACE_TEMPLATE = """\
+@font-face {{
+  font-family: "{family}";
+  font-style: normal;
+  font-weight: 400;
+  font-display: swap;
+  src: url({fname}) format("woff2");
+}}
+"""
+
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+
+# woff/ttf fallbacks in the KaTeX `@font-face` rules, e.g.,
+# `,url(fonts/KaTeX_Main-Bold.woff) format("woff")`.
+FONT_FALLBACK_RE = re.compile(
+    r""",\s*url\([^)]+\.(?:woff|ttf)\)\s*format\(["'](?:woff|truetype)["']\)"""
+)
+
+
+def download(url: str) -> bytes:
+    request = urllib.request.Request(
+        url, headers={"User-Agent": "nrsyed-vendor-assets"}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+def sri_hash(data: bytes) -> str:
+    return "sha384-" + base64.b64encode(hashlib.sha384(data).digest()).decode()
+
+
+@instrument.timed
+def fetch(static_dir: pathlib.Path = pathlib.Path("static")):
+    """
+    Download KaTeX and the Abril Fatface font into the `vendor/` directory of
+    the site's static files, `static_dir`.
+
+    Raises:
+        ValueError: If a KaTeX file does not match its SRI hash.
+    """
+    static_dir = pathlib.Path(static_dir)
+    katex_dir = static_dir / KATEX_DIR
+
+    for fname, expected_hash in KATEX_FILES.items():
+        data = download(KATEX_URL + fname)
+        if sri_hash(data) != expected_hash:
+            raise ValueError(f"SRI hash mismatch for {KATEX_URL + fname}")
+
+        if fname.endswith(".css"):
+            css = FONT_FALLBACK_RE.sub("", data.decode("utf-8"))
+            font_urls = sorted(set(CSS_URL_RE.findall(css)))
+            for font_url in font_urls:
+                font_fpath = katex_dir / font_url
+                font_fpath.parent.mkdir(parents=True, exist_ok=True)
+                font_fpath.write_bytes(download(KATEX_URL + font_url))
+            data = css.encode("utf-8")
+            print(f"Fetched {len(font_urls)} KaTeX fonts")
+
+        fpath = katex_dir / fname
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_bytes(data)
+
+    # Without a browser User-Agent, Google Fonts serves TrueType, which is
+    # converted to woff2. The full font is published as is until a build
+    # subsets it (see :func:`subset_web_font`).
+    font_css = download(FONT_CSS_URL).decode("utf-8")
+    font = TTFont(io.BytesIO(download(CSS_URL_RE.search(font_css).group(1))))
+    font.flavor = "woff2"
+
+    font_dir = static_dir / FONT_DIR
+    font_dir.mkdir(parents=True, exist_ok=True)
+    font.save(font_dir / FONT_SUBSET_FNAME)
+    with open(font_dir / FONT_CSS_FNAME, "w") as f:
+        f.write(
+            FONT_FACE_TEMPLATE.format(
+                family=FONT_FAMILY, fname=FONT_SUBSET_FNAME
+            )
+        )
+
+    print(f"Fetched vendored assets into {static_dir / 'vendor'}")
+
+
+def missing_assets(static_dir: pathlib.Path = pathlib.Path("static")) -> list:
+    """
+    Return the paths, relative to `static_dir`, of the vendored assets that
+    have not been fetched (see :func:`fetch`), including the KaTeX fonts
+    referenced by a fetched `katex.min.css`.
+    """
+    static_dir = pathlib.Path(static_dir)
+    katex_dir = pathlib.Path(KATEX_DIR)
+
+    fpaths = [katex_dir / fname for fname in KATEX_FILES]
+    css_fpath = static_dir / katex_dir / "katex.min.css"
+    if css_fpath.is_file():
+        css = css_fpath.read_text(encoding="utf-8")
+        fpaths.extend(
+            katex_dir / font_url
+            for font_url in sorted(set(CSS_URL_RE.findall(css)))
+        )
+    fpaths.append(pathlib.Path(FONT_DIR) / FONT_SUBSET_FNAME)
+    fpaths.append(pathlib.Path(FONT_DIR) / FONT_CSS_FNAME)
+
+    return [fpath for fpath in fpaths if not (static_dir / fpath).is_file()]
+
+
+@instrument.timed
+def selector_text(fpath: pathlib.Path) -> set:
+    """
+    Return the set of characters in the elements of an HTML page that are
+    rendered in the vendored font.
+    """
+    with open(fpath, "r", encoding="utf-8") as f:
+        soup = bs4.BeautifulSoup(f, "html.parser")
+    return {
+        char for elem in soup.select(FONT_SELECTOR)
+        for char in elem.get_text()
+    }
+
+
+@instrument.timed
+def subset_font(src_fpath: pathlib.Path, dst_fpath: pathlib.Path, text: str):
+    """
+    Write a woff2 subset of the font at `src_fpath` containing only the
+    glyphs needed to render `text`. `dst_fpath` may be `src_fpath`.
+    """
+    options = subset.Options()
+    options.flavor = "woff2"
+
+    # Read the whole font first so it can be overwritten by its subset.
+    font = TTFont(io.BytesIO(pathlib.Path(src_fpath).read_bytes()))
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+    subset.save_font(font, dst_fpath, options)
+
+
+@instrument.timed
+def subset_web_font(
+    build_dir: pathlib.Path,
+    max_workers: int = None,
+    pool: instrument.ProcessPool = None,
+):
+    """
+    Subset the published web font in `build_dir` to the characters rendered
+    in it.
+
+    Args:
+        build_dir: Path to the built site (e.g., `public`).
+        max_workers: Number of processes used to parse pages.
+        pool: Process pool to parse pages with instead of a new one.
+
+    Raises:
+        FileNotFoundError: If the font has not been fetched (see
+            :func:`fetch`).
+    """
+    build_dir = pathlib.Path(build_dir)
+    font_fpath = build_dir / FONT_DIR / FONT_SUBSET_FNAME
+
+    if not font_fpath.is_file():
+        raise FileNotFoundError(
+            f"{FONT_FAMILY} not found in {font_fpath.parent}; run "
+            "`python tools/vendor_assets.py fetch` to self-host it"
+        )
+
+    with instrument.span("vendor_assets.selector_text"):
+        chars = set().union(*(
+            page_chars for _, page_chars in site_pages.map_pages(
+                selector_text, build_dir, pool=pool, max_workers=max_workers
+            )
+        ))
+
+    # Keep the space so word spacing does not fall back to another font.
+    text = "".join(sorted(chars | {" "}))
+
+    subset_font(font_fpath, font_fpath, text)
+
+    print(
+        f"Subset {FONT_FAMILY} to {len(text)} characters "
+        f"({font_fpath.stat().st_size} bytes)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "action", type=str, choices=["fetch", "subset"],
+        help="fetch (download assets into static/vendor/) or subset (subset "
+            "the web font in a built site)"
+    )
+    parser.add_argument(
+        "build_dir", type=pathlib.Path, nargs="?", default="public",
+        help="Path to built site"
+    )
+    parser.add_argument(
+        "--static-dir", type=pathlib.Path, default="static",
+        help="Path to the site's static files, into whose vendor/ directory "
+            "assets are fetched"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument.profile_run(args):
+        if args.action == "fetch":
+            fetch(args.static_dir)
+        else:
+            subset_web_font(args.build_dir)
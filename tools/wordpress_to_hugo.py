@@ -1,13 +1,41 @@
+"""
+Migrate posts from a WordPress export (WXR) file to Hugo posts in a single
+pass. Posts are streamed out of the export one <item> at a time, their HTML
+converted to markdown with reference-style links, run through the
+:mod:`format_posts` fixes and reference renumbering in memory, and written to
+the destination directory by a pool of worker processes. A post that fails to
+convert is reported without stopping the migration of the others.
+"""
+import argparse
+from concurrent.futures import wait, FIRST_COMPLETED
+import datetime
+import html
 import os
+import pathlib
 import re
+import sys
+import time
+from typing import List
+import xml.etree.ElementTree as ET
+
+import bs4
+
+from format_posts import format_lines
+import instrument
+from renumber_refs import renumber_lines
+
+
+_wp = "{http://wordpress.org/export/1.2/}"
+_content = "{http://purl.org/rss/1.0/modules/content/}"
 
 
 def copy_posts(src_dir, dst_dir):
     num_untitled = 0
 
-    for fname in os.listdir(src_dir):
+    # Sort so that untitled posts are numbered the same way on every run.
+    for fname in sorted(os.listdir(src_dir)):
         src_fpath = os.path.join(src_dir, fname)
-        
+
         expr = r"\d{4}-\d{2}-\d{2}-(.*)"
         match = re.match(expr, fname)
 
@@ -19,6 +47,371 @@ def copy_posts(src_dir, dst_dir):
         print(dst_fname)
 
 
+def iter_items(wxr_fpath, post_type="post", status="publish"):
+    """
+    Lazily parse a WXR file, yielding its <item> elements. Each element is
+    discarded as soon as the consumer moves on to the next one, so memory use
+    does not grow with the size of the export.
+
+    Args:
+        wxr_fpath: Path to WordPress export (WXR) file.
+        post_type (str): Only yield items with this `wp:post_type`.
+        status (str): Only yield items with this `wp:status`; `None` to yield
+            items regardless of status.
+    Yields:
+        `xml.etree.ElementTree.Element` of each matching <item>.
+    """
+    context = ET.iterparse(wxr_fpath, events=("start", "end"))
+    channel = None
+
+    for event, elem in context:
+        if event == "start":
+            if elem.tag == "channel":
+                channel = elem
+            continue
+
+        if elem.tag != "item":
+            continue
+
+        if (
+            elem.findtext(f"{_wp}post_type") == post_type
+            and (status is None or elem.findtext(f"{_wp}status") == status)
+        ):
+            yield elem
+
+        # Free the item (and its reference from the channel) once processed.
+        elem.clear()
+        if channel is not None:
+            channel.remove(elem)
+
+
+def iter_posts(wxr_fpath, post_type="post", status="publish"):
+    """
+    Lazily parse a WXR file, yielding one dict per post (see
+    :func:`iter_items`).
+
+    Yields:
+        dict with keys "post_id", "post_name", "title", "date", "date_gmt",
+        "author", "categories", "tags", "content".
+    """
+    for elem in iter_items(wxr_fpath, post_type=post_type, status=status):
+        categories = []
+        tags = []
+        for category in elem.findall("category"):
+            if category.get("domain") == "category":
+                categories.append(category.text)
+            elif category.get("domain") == "post_tag":
+                tags.append(category.text)
+
+        yield {
+            "post_id": int(elem.findtext(f"{_wp}post_id")),
+            "post_name": elem.findtext(f"{_wp}post_name") or "",
+            "title": elem.findtext("title") or "",
+            "date": elem.findtext(f"{_wp}post_date"),
+            "date_gmt": elem.findtext(f"{_wp}post_date_gmt"),
+            "author": elem.findtext(
+                "{http://purl.org/dc/elements/1.1/}creator"
+            ),
+            "categories": categories,
+            "tags": tags,
+            "content": elem.findtext(f"{_content}encoded") or "",
+        }
+
+
+def post_header(post, author="Najam Syed"):
+    """
+    Return the YAML front matter lines for a post in the same layout as the
+    existing posts in `content/blog`.
+    """
+    date = datetime.datetime.strptime(post["date"], "%Y-%m-%d %H:%M:%S")
+    date_gmt = datetime.datetime.strptime(
+        post["date_gmt"], "%Y-%m-%d %H:%M:%S"
+    )
+    title = post["title"].replace('"', '\\"')
+
+    header = [
+        "---",
+        f'title: "{title}"',
+        f"author: {author}",
+        "type: post",
+        f"date: {date_gmt.strftime('%Y-%m-%dT%H:%M:%S')}+00:00",
+    ]
+
+    if post["post_name"]:
+        header.append(
+            f"url: /{date.strftime('%Y/%m/%d')}/{post['post_name']}/"
+        )
+
+    for key in ("categories", "tags"):
+        if post[key]:
+            header.append(f"{key}:")
+            header.extend(f"  - {value}" for value in post[key])
+
+    header.append("")
+    header.append("---")
+    return header
+
+
+def post_fname(post, untitled_num=None):
+    """
+    Return the destination filename for a post, e.g.,
+    `2018-05-06-hog-based-svm-for-detecting-vehicles-in-a-video-part-1.md`.
+    Posts without a slug are named `untitled_<untitled_num>.md`.
+    """
+    if not post["post_name"]:
+        return f"untitled_{untitled_num}.md"
+    date = post["date"].split(" ")[0]
+    return f"{date}-{post['post_name']}.md"
+
+
+# Elements copied into the markdown as raw HTML blocks; <pre> and <img> are
+# converted to shortcodes by `format_lines`.
+RAW_BLOCK_TAGS = ("pre", "table", "iframe", "script", "style", "img")
+CONTAINER_TAGS = ("p", "div", "figure", "blockquote", "center")
+HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+
+
+def _linked_image(tag):
+    """
+    Return the <img> of an <a> whose only content is an image, e.g., a
+    thumbnail linked to the full-size upload, or `None`.
+    """
+    children = [
+        child for child in tag.children
+        if not (isinstance(child, bs4.NavigableString) and not child.strip())
+    ]
+    if len(children) == 1 and getattr(children[0], "name", None) == "img":
+        return children[0]
+    return None
+
+
+class _MarkdownConverter:
+    """
+    Converts the HTML of a post body to markdown, collecting its links into a
+    reflist so that they are written as reference-style links.
+    """
+    def __init__(self):
+        self.links = {}
+
+    def ref(self, url):
+        """
+        Return the reflist number of a URL, adding it to the reflist if new.
+        """
+        return self.links.setdefault(url, len(self.links) + 1)
+
+    def inline(self, node):
+        if isinstance(node, bs4.Comment):
+            return ""
+        if isinstance(node, bs4.NavigableString):
+            # Keep non-ASCII characters as character references, as in the
+            # existing posts; `format_lines` truncates lines containing some
+            # of them.
+            text = html.escape(str(node), quote=False)
+            return text.encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+        if node.name == "br":
+            return "\n"
+        if node.name == "img":
+            return str(node)
+        if node.name == "code":
+            return f"`{node.get_text()}`"
+
+        text = "".join(self.inline(child) for child in node.children)
+        if node.name in ("strong", "b") and text.strip():
+            return f"**{text.strip()}**"
+        if node.name in ("em", "i") and text.strip():
+            return f"*{text.strip()}*"
+        if node.name == "a" and node.get("href"):
+            image = _linked_image(node)
+            if image is not None:
+                return str(image)
+            return f"[{text.strip()}][{self.ref(node['href'].strip())}]"
+        return text
+
+    def list_items(self, node):
+        """
+        Return the lines of a <ul> or <ol>; nested lists are flattened, since
+        `format_lines` strips indentation.
+        """
+        lines = []
+        items = node.find_all("li", recursive=False)
+        for num, item in enumerate(items, start=1):
+            nested = item.find_all(["ul", "ol"], recursive=False)
+            text = "".join(
+                self.inline(child) for child in item.children
+                if child not in nested
+            )
+            marker = f"{num}." if node.name == "ol" else "*"
+            lines.append(f"{marker} {' '.join(text.split())}")
+            for sublist in nested:
+                lines.extend(self.list_items(sublist))
+        return lines
+
+    def blocks(self, node):
+        """
+        Return the markdown blocks (paragraphs, headings, lists, and raw HTML
+        blocks) of an element, to be separated by blank lines.
+        """
+        blocks = []
+        paragraph = []
+
+        def end_paragraph():
+            # WordPress separates paragraphs in post content with blank lines
+            # rather than <p> tags.
+            text = "".join(paragraph)
+            blocks.extend(
+                block.strip() for block in re.split(r"\n\s*\n", text)
+                if block.strip()
+            )
+            paragraph.clear()
+
+        for child in node.children:
+            name = getattr(child, "name", None)
+            if name == "a" and _linked_image(child) is not None:
+                end_paragraph()
+                blocks.append(str(_linked_image(child)))
+            elif name in RAW_BLOCK_TAGS:
+                end_paragraph()
+                blocks.append(str(child))
+            elif name in HEADING_TAGS:
+                # Post titles are the only <h1>, so <h2> is the top level
+                # heading in a post (`#`), as in the existing posts.
+                end_paragraph()
+                level = max(int(name[1]) - 1, 1)
+                text = " ".join(self.inline(child).split())
+                blocks.append(f"{'#' * level} {text}")
+            elif name in ("ul", "ol"):
+                end_paragraph()
+                blocks.append("\n".join(self.list_items(child)))
+            elif name == "hr":
+                end_paragraph()
+                blocks.append("* * *")
+            elif name in CONTAINER_TAGS:
+                end_paragraph()
+                blocks.extend(self.blocks(child))
+            else:
+                paragraph.append(self.inline(child))
+
+        end_paragraph()
+        return blocks
+
+
+def html_to_markdown(content: str) -> List[str]:
+    """
+    Convert the HTML content of a post to markdown lines. Links are written
+    as reference-style links (`[text][1]`) with a reflist at the end, in the
+    form expected by :func:`renumber_refs.renumber_lines`.
+    """
+    converter = _MarkdownConverter()
+    soup = bs4.BeautifulSoup(content.replace("\r\n", "\n"), "html.parser")
+    lines = "\n\n".join(converter.blocks(soup)).split("\n")
+
+    if converter.links:
+        lines.append("")
+        lines.extend(
+            f"[{refnum}]: {url}" for url, refnum in converter.links.items()
+        )
+    return lines
+
+
+@instrument.timed
+def convert_post(post, dst_fpath, max_line_len=80):
+    """
+    Convert a post dict (see :func:`iter_posts`) to a finished Hugo post and
+    write it to `dst_fpath`. Runs in a worker process.
+    """
+    lines = post_header(post)
+    lines.extend(html_to_markdown(post["content"]))
+
+    text = format_lines(lines, max_line_len=max_line_len)
+    lines = text.splitlines(keepends=True)
+
+    # Only posts ending in a reflist have reference-style links to renumber.
+    if lines and re.match(r"\[\d+\]: ", lines[-1]):
+        lines = renumber_lines(lines)
+
+    with open(dst_fpath, "w") as f:
+        f.writelines(lines)
+    return dst_fpath
+
+
+@instrument.timed
+def migrate(wxr_fpath, dst_dir, max_workers=None, max_pending=None):
+    """
+    Stream posts from `wxr_fpath` and convert them to Hugo posts in `dst_dir`
+    across a process pool.
+
+    Args:
+        wxr_fpath: Path to WordPress export (WXR) file.
+        dst_dir: Output directory for the Hugo posts.
+        max_workers (int): Number of worker processes (default: CPU count).
+        max_pending (int): Maximum number of posts submitted to the pool but
+            not yet written; bounds the memory used by queued posts. Defaults
+            to four times the number of workers.
+    Returns:
+        Tuple of the sorted list of paths of the written posts and a list of
+        (post filename, exception) tuples for the posts that failed.
+    """
+    dst_dir = pathlib.Path(dst_dir)
+    dst_dir.mkdir(parents=True, exist_ok=True)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 4 * max_workers
+
+    written = []
+    failed = []
+    pending = {}
+    num_untitled = 0
+
+    def collect(done):
+        for future in done:
+            fname = pending.pop(future)
+            try:
+                written.append(future.result())
+            except Exception as e:
+                failed.append((fname, e))
+
+    with instrument.ProcessPool(max_workers=max_workers) as pool:
+        # Untitled posts are numbered in the order they appear in the export,
+        # which (unlike directory listing order) is the same on every run.
+        for post in iter_posts(wxr_fpath):
+            if post["post_name"]:
+                fname = post_fname(post)
+            else:
+                fname = post_fname(post, untitled_num=num_untitled)
+                num_untitled += 1
+
+            if len(pending) >= max_pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+            pending[pool.submit(convert_post, post, dst_dir / fname)] = fname
+
+        collect(wait(pending).done)
+
+    return sorted(written), failed
+
+
 if __name__ == "__main__":
-    src_dir = os.path.expanduser("~/nrsyed.com/hugo-export/posts")
-    copy_posts(src_dir, "")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", type=pathlib.Path, help="WXR export file")
+    parser.add_argument(
+        "dst", type=pathlib.Path, help="Destination directory for Hugo posts"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Number of worker processes (default: number of CPUs)"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    start_t = time.time()
+    with instrument.profile_run(args):
+        fpaths, failed = migrate(args.src, args.dst, max_workers=args.jobs)
+    elapsed = time.time() - start_t
+    print(f"Migrated {len(fpaths)} posts in {elapsed:.2f} s")
+
+    for fname, e in failed:
+        print(f"Failed to migrate {fname}: {type(e).__name__}: {e}")
+    sys.exit(1 if failed else 0)
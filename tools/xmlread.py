@@ -1,41 +1,70 @@
-import json
-import xml.etree.ElementTree as ET
+import argparse
+import pathlib
 
+import comment_store
+import instrument
+from wordpress_to_hugo import _wp, iter_items
 
-def parse(fname):
-    tree = ET.parse(fname)
-    root = tree.getroot()
-    channel = root[0]
 
-    posts = []
+def iter_posts(fname):
+    """
+    Lazily parse a WordPress export, yielding each post (of any status) with
+    its comments (see :func:`wordpress_to_hugo.iter_items`).
+    """
+    for elem in iter_items(fname, status=None):
+        post = {
+            "title": elem.findtext("title"),
+            "post_id": elem.findtext(f"{_wp}post_id"),
+            "post_name": elem.findtext(f"{_wp}post_name"),
+            "comments": [],
+        }
+
+        for comment in elem.findall(f"{_wp}comment"):
+            comment_ = {
+                comment_elem.tag[len(f"{_wp}"):]: comment_elem.text
+                for comment_elem in comment
+            }
+            post["comments"].append(comment_)
+        yield post
 
-    _wp = "{http://wordpress.org/export/1.2/}"
 
-    for elem in channel:
-        if elem.tag == "item":
-            guid = elem[4]
+@instrument.timed
+def parse(fname):
+    return list(iter_posts(fname))
 
-            if "?p=" in guid.text:
-                post = {
-                    "title": elem.find("title").text,
-                    "post_id": elem.find(f"{_wp}post_id").text,
-                    "post_name": elem.find(f"{_wp}post_name").text,
-                    "comments": [],
-                }
 
-                for comment in elem.findall(f"{_wp}comment"):
-                    comment_ = {
-                        comment_elem.tag[len(f"{_wp}"):]: comment_elem.text
-                        for comment_elem in comment
-                    }
-                    post["comments"].append(comment_)
-                posts.append(post)
-    return posts
+@instrument.timed
+def load_into_store(fname, store_path, json_path=None):
+    """
+    Stream the posts and comments in a WordPress export into the comment
+    store at `store_path` (see :mod:`comment_store`) and, if `json_path` is
+    given, also write them to a JSON file in the layout of the old
+    `posts.json` (see :func:`comment_store.export_json`).
+    """
+    conn = comment_store.open_store(store_path)
+    comment_store.add_posts(conn, iter_posts(fname))
+    if json_path is not None:
+        comment_store.export_json(conn, json_path)
+    conn.close()
 
 
 if __name__ == "__main__":
-    fname = "najamrsyed.WordPress.2021-01-30_2.xml"
-    posts = parse(fname)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "fname", nargs="?", default="najamrsyed.WordPress.2021-01-30_2.xml",
+        help="Path to WordPress export"
+    )
+    parser.add_argument(
+        "--store", default="comments_store.db",
+        help="Path to comment store"
+    )
+    parser.add_argument(
+        "--export-json", type=pathlib.Path, default=None, metavar="PATH",
+        help="Also write the posts and comments to a JSON file in the layout "
+            "of the old posts.json"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
 
-    out_fname = "posts.json"
-    json.dump(posts, open(out_fname, "w"), indent=2)
+    with instrument.profile_run(args):
+        load_into_store(args.fname, args.store, json_path=args.export_json)